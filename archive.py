@@ -0,0 +1,389 @@
+"""Helpers for moving files between .qp and .osz archives"""
+
+# ## Imports
+
+import collections  # queue of the members that are still being compressed
+import concurrent.futures  # threads compressing the members of new archives
+import contextlib  # to write into several archives at once
+import hashlib  # to recognize assets that were already copied
+import mmap  # to read .qp files straight from the page cache
+import os  # to move finished archives into place
+import secrets  # for unique names of the archives that are still being written
+import struct  # to read the local file headers of zip members
+import time  # for the modification time of new members
+import zipfile  # to handle .zip files (.qua and .osz)
+import zlib  # to inflate members of memory-mapped archives
+
+# ## Constants
+
+# Size of the chunks used to copy files between archives
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Compression methods that can be copied as they are, osu! can read both
+RAW_COPY_COMPRESSIONS = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+
+# General purpose flags of zip members
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+
+# Suffix of .osz files that are still being written, they're renamed once they're complete
+PARTIAL_SUFFIX = ".part"
+
+# Compression level that stores every member uncompressed, see `ArchiveWriter`
+STORE_LEVEL = 0
+
+# ## Functions
+
+
+def canCopyRaw(info: zipfile.ZipInfo) -> bool:
+    """Checks if the compressed bytes of a member can be copied without decompressing them"""
+
+    return info.compress_type in RAW_COPY_COMPRESSIONS and not info.flag_bits & FLAG_ENCRYPTED
+
+
+def readChunksRaw(source: zipfile.ZipFile, info: zipfile.ZipInfo):
+    """Yields the compressed bytes of a member in chunks"""
+
+    # A memory-mapped archive hands out the whole member without reading or copying it
+    if isinstance(source, MappedZipFile):
+        yield source.memberView(info)
+        return
+
+    # Reads the local file header to find out where the data starts,
+    # the name and extra field lengths can differ from the central directory
+    source.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, source.fp.read(zipfile.sizeFileHeader))
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header of {info.filename}")
+    source.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.fp.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data of {info.filename}")
+        yield chunk
+        remaining -= len(chunk)
+
+
+def hashChunks(chunks, digest=None):
+    """Passes chunks through and feeds them to `digest` on the way, if one is given"""
+
+    for chunk in chunks:
+        if digest is not None:
+            digest.update(chunk)
+        yield chunk
+
+
+def writeMemberRaw(info: zipfile.ZipInfo, chunks, target: zipfile.ZipFile) -> None:
+    """Writes a member from its compressed bytes, the CRC and sizes are taken over from `info`"""
+
+    writeMemberRawToAll(info, chunks, [target])
+
+
+def writeMemberRawToAll(info: zipfile.ZipInfo, chunks, targets: list) -> None:
+    """Writes a member from its compressed bytes into several archives, going over the chunks only once"""
+
+    newInfos = []
+
+    # Same bookkeeping as `ZipFile.writestr()` does for regular members
+    with contextlib.ExitStack() as stack:
+        for target in targets:
+            stack.enter_context(target._lock)
+
+            newInfo = zipfile.ZipInfo(info.filename, info.date_time)
+            newInfo.compress_type = info.compress_type
+            newInfo.external_attr = info.external_attr
+            newInfo.CRC = info.CRC
+            newInfo.compress_size = info.compress_size
+            newInfo.file_size = info.file_size
+            # The real sizes are written into the header, so no data descriptor follows the data
+            newInfo.flag_bits = info.flag_bits & ~FLAG_DATA_DESCRIPTOR
+
+            target.fp.seek(target.start_dir)
+            newInfo.header_offset = target.fp.tell()
+            target._writecheck(newInfo)
+            target._didModify = True
+            target.fp.write(newInfo.FileHeader())
+            newInfos.append(newInfo)
+
+        for chunk in chunks:
+            for target in targets:
+                target.fp.write(chunk)
+
+        for target, newInfo in zip(targets, newInfos):
+            target.filelist.append(newInfo)
+            target.NameToInfo[newInfo.filename] = newInfo
+            target.start_dir = target.fp.tell()
+
+
+def copyMember(source: zipfile.ZipFile, info: zipfile.ZipInfo, target: zipfile.ZipFile, raw: bool = True) -> None:
+    """Copies a member from one archive to another
+
+    Passes the compressed bytes through unchanged if possible, otherwise the
+    member is decompressed and stored uncompressed, since audio files and
+    images barely get any smaller by compressing them again
+    """
+
+    copyMemberToAll(source, info, [target], raw)
+
+
+def storedInfo(info: zipfile.ZipInfo) -> zipfile.ZipInfo:
+    """Returns a new info for storing a member uncompressed, each archive needs its own"""
+
+    newInfo = zipfile.ZipInfo(info.filename, info.date_time)
+    newInfo.compress_type = zipfile.ZIP_STORED
+    newInfo.external_attr = info.external_attr
+    newInfo.file_size = info.file_size
+
+    return newInfo
+
+
+def copyMemberToAll(source: zipfile.ZipFile, info: zipfile.ZipInfo, targets: list, raw: bool = True,
+                    digest=None) -> int:
+    """Copies a member into several archives like `copyMember()`, reading it only once
+
+    The member is streamed in chunks and never held in memory as a whole,
+    the bytes written into each archive are fed to `digest` if one is given.
+    Returns the amount of these bytes.
+    """
+
+    if raw and canCopyRaw(info):
+        writeMemberRawToAll(info, hashChunks(readChunksRaw(source, info), digest), targets)
+        return info.compress_size
+    else:
+        with contextlib.ExitStack() as stack:
+            sourceFile = stack.enter_context(source.open(info))
+            targetFiles = [stack.enter_context(target.open(storedInfo(info), "w")) for target in targets]
+            chunks = hashChunks(iter(lambda: sourceFile.read(COPY_CHUNK_SIZE), b""), digest)
+            for chunk in chunks:
+                for targetFile in targetFiles:
+                    targetFile.write(chunk)
+        return info.file_size
+
+
+def copyAsset(source: zipfile.ZipFile, info: zipfile.ZipInfo, writers: list, hashed: bool = False) -> tuple:
+    """Copies a member of another archive into the archives of several `ArchiveWriter`s
+
+    Comes after the members added to them before, the member is only read
+    once for all of them. Passes the compressed bytes through unchanged,
+    writers with `STORE_LEVEL` store it decompressed instead. If `hashed`,
+    returns the SHA-256 hex digest and size of the bytes written into the
+    first archive, to recognize the same asset in other mapsets, otherwise None.
+    """
+
+    groups = {}
+    for writer in writers:
+        writer.flush()
+        raw = writer.compressionLevel != STORE_LEVEL or info.compress_type == zipfile.ZIP_STORED
+        groups.setdefault(raw, []).append(writer.target)
+
+    digest = hashlib.sha256() if hashed else None
+    asset = None
+
+    for raw, targets in groups.items():
+        size = copyMemberToAll(source, info, targets, raw, digest)
+        if digest is not None and asset is None:
+            asset = digest.hexdigest(), size
+            # The other groups store different bytes, only the first one is hashed
+            digest = None
+
+    return asset
+
+
+def compressMember(data: bytes, level: int) -> tuple:
+    """Deflates the data of a member, returns the compressed bytes and the CRC-32
+
+    zlib releases the GIL for both, so several members can be compressed in parallel threads
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data)
+
+
+def createPartial(outputPath: str) -> str:
+    """Creates an empty file next to `outputPath` that only the caller writes, returns its path
+
+    Every conversion gets its own file, even if several mapsets have the same
+    output path. The name still ends with the extension of the output and
+    `PARTIAL_SUFFIX`, so that leftovers of an interrupted run can be found.
+    """
+
+    stem, extension = os.path.splitext(outputPath)
+
+    while True:
+        partialPath = f"{stem}.{secrets.token_hex(4)}{extension}{PARTIAL_SUFFIX}"
+        try:
+            # Unlike `tempfile.mkstemp()` this keeps the usual permissions of new files
+            with open(partialPath, "xb"):
+                return partialPath
+        except FileExistsError:
+            continue
+
+
+def replacePartial(partialPath: str, outputPath: str) -> None:
+    """Moves a finished partial file to the output path once its content reached the disk
+
+    Otherwise a power loss could leave a truncated file under the final name.
+    """
+
+    with open(partialPath, "rb+") as file:
+        os.fsync(file.fileno())
+
+    os.replace(partialPath, outputPath)
+
+
+def openArchive(path: str, mapped: bool = False) -> zipfile.ZipFile:
+    """Opens an archive for reading, as `MappedZipFile` if `mapped` is set
+
+    Falls back to a regular `zipfile.ZipFile` if the file can't be
+    memory-mapped, e.g. because it's empty or on a file system without
+    support for it.
+    """
+
+    if mapped:
+        try:
+            return MappedZipFile(path)
+        except (OSError, ValueError):
+            pass
+
+    return zipfile.ZipFile(path, "r")
+
+# ## Classes
+
+
+class ArchiveWriter:
+    """Writes new members into an archive in order, compressing them in parallel
+
+    With a `compressionLevel` from 1 to 9 the members are deflated at that
+    level by the threads of `executor`, while the next members are already
+    being prepared. They're still written in the order they were added.
+    Without a level they're stored uncompressed right away. `copyAsset()`
+    takes members over from another archive.
+
+    Counts the bytes of the added members before and after the compression
+    in `size` and `compressedSize`.
+    """
+
+    def __init__(self, target: zipfile.ZipFile, compressionLevel: int = None,
+                 executor: concurrent.futures.Executor = None):
+        self.target = target
+        self.compressionLevel = compressionLevel
+        self.executor = executor
+        self.size = 0
+        self.compressedSize = 0
+        # (info, future) of the members that are still being compressed, in order
+        self.pending = collections.deque()
+
+    def writestr(self, name: str, data: bytes) -> None:
+        info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        # Same permissions as `ZipFile.writestr()` gives new files
+        info.external_attr = 0o600 << 16
+        info.file_size = len(data)
+        self.size += len(data)
+
+        if not self.compressionLevel or self.executor is None:
+            self.flush()
+            info.compress_type = zipfile.ZIP_STORED
+            self.target.writestr(info, data)
+            self.compressedSize += len(data)
+            return
+
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self.pending.append((info, self.executor.submit(compressMember, data, self.compressionLevel)))
+
+        # Writes what's already compressed, so finished members don't pile up in memory
+        while self.pending and self.pending[0][1].done():
+            self.writePending()
+
+    def writePending(self) -> None:
+        info, future = self.pending.popleft()
+        compressed, info.CRC = future.result()
+        info.compress_size = len(compressed)
+        self.compressedSize += len(compressed)
+        writeMemberRaw(info, [compressed], self.target)
+
+    def flush(self) -> None:
+        """Waits for all pending members and writes them"""
+
+        while self.pending:
+            self.writePending()
+
+
+class MappedZipFile(zipfile.ZipFile):
+    """Archive that reads the data of its members from a memory map of the file
+
+    The central directory is parsed by `zipfile` as usual, but `read()` and
+    the raw copies of `readChunksRaw()` take the compressed bytes straight
+    out of the mapped file as `memoryview` slices, instead of going through
+    many small buffered reads and seeks. Members that need a password or an
+    unusual compression method are left to `zipfile`.
+    """
+
+    def __init__(self, path: str):
+        self.map = None
+        self.view = None
+        self.file = open(path, "rb")
+
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+            super().__init__(self.file, "r")
+        except BaseException:
+            self.closeMap()
+            raise
+
+    def memberView(self, info: zipfile.ZipInfo) -> memoryview:
+        """Returns the compressed bytes of a member without copying them"""
+
+        # The name and extra field lengths in the local file header can differ from the central directory
+        header = struct.unpack_from(zipfile.structFileHeader, self.map, info.header_offset)
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Bad local file header of {info.filename}")
+
+        start = info.header_offset + zipfile.sizeFileHeader + \
+            header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH]
+        end = start + info.compress_size
+        if end > len(self.map):
+            raise zipfile.BadZipFile(f"Truncated data of {info.filename}")
+
+        return self.view[start:end]
+
+    def read(self, name, pwd: bytes = None) -> bytes:
+        info = name if isinstance(name, zipfile.ZipInfo) else self.getinfo(name)
+
+        if pwd is not None or not canCopyRaw(info):
+            return super().read(name, pwd)
+
+        with self.memberView(info) as view:
+            if info.compress_type == zipfile.ZIP_STORED:
+                data = bytes(view)
+            else:
+                data = zlib.decompress(view, -zlib.MAX_WBITS, info.file_size)
+
+        if zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename}")
+
+        return data
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            self.closeMap()
+
+    def closeMap(self) -> None:
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Someone still holds a slice of a member, the map is closed once it's garbage collected
+                pass
+            self.map = None
+
+        self.file.close()
@@ -0,0 +1,105 @@
+"""Memory of a difficulty in reamber's objects, the parsed .qua dicts and a `ColumnarChart`
+
+Measures with tracemalloc how much memory each representation of a
+synthetic map keeps after parsing and the peak while converting it to
+.osu text. Fails if the columnar conversion doesn't peak at least
+`--min-ratio` times lower than the reamber one.
+
+Run with `py benchmarks/chartmemory.py --notes 50000`
+"""
+
+# ## Imports
+
+import argparse  # parsing command line arguments
+import gc  # to start each measurement from a clean heap
+import io  # to collect the .osu text in memory
+import os  # for paths and directories
+import sys  # to make the root modules importable
+import tracemalloc  # to measure the memory of the Python objects and arrays
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from columnar import ColumnarChart  # noqa: E402
+from conversion import DEFAULT_OPTIONS, applyOptions, parseQua, readQua, writeOsu, writeOsuDirect  # noqa: E402
+from synthetic import makeQua  # noqa: E402
+
+# ## Representations
+
+
+def reamberParse(data: bytes):
+    from reamber.algorithms.convert import QuaToOsu
+
+    return QuaToOsu.convert(readQua(data))
+
+
+def reamberWrite(osu, options) -> str:
+    applyOptions(osu, options)
+    return writeOsu(osu)
+
+
+def dictWrite(qua: dict, options) -> str:
+    stream = io.StringIO()
+    writeOsuDirect(qua, options, stream)
+    return stream.getvalue()
+
+
+def columnarWrite(chart: ColumnarChart, options) -> str:
+    stream = io.StringIO()
+    chart.applyOptions(options)
+    chart.write(options, stream)
+    return stream.getvalue()
+
+
+REPRESENTATIONS = {
+    "reamber": (reamberParse, reamberWrite),
+    "dict": (parseQua, dictWrite),
+    "columnar": (ColumnarChart.parse, columnarWrite)
+}
+
+# ## Functions
+
+
+def measure(parse, write, data: bytes, options) -> tuple:
+    """Returns the bytes kept by the parsed map and the peak bytes of parsing and writing it"""
+
+    # Imports and caches of the first run don't count
+    write(parse(data), options)
+    gc.collect()
+
+    tracemalloc.start()
+    try:
+        parsed = parse(data)
+        retained = tracemalloc.get_traced_memory()[0]
+        write(parsed, options)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return retained, peak
+
+
+def main():
+    argParser = argparse.ArgumentParser("Compares the memory of the chart representations")
+    argParser.add_argument("--notes", help="Notes and SVs of the map, defaults to 50000", default=50000, type=int)
+    argParser.add_argument("--min-ratio", help="Minimum peak memory ratio of reamber to columnar, defaults to 5",
+                           default=5, type=float)
+    args = argParser.parse_args()
+
+    data = makeQua("Memory", notes=args.notes, svs=args.notes).encode()
+    options = {**DEFAULT_OPTIONS, "hitSoundVolume": 30, "sampleSet": "Drum"}
+
+    print(f"Map with {args.notes} notes and SVs, {len(data) / 1024 / 1024:.1f} MiB")
+
+    peaks = {}
+    for name, (parse, write) in REPRESENTATIONS.items():
+        retained, peaks[name] = measure(parse, write, data, options)
+        print(f"{name:>9}: {retained / 1024 / 1024:8.1f} MiB kept, {peaks[name] / 1024 / 1024:8.1f} MiB peak")
+
+    ratio = peaks["reamber"] / peaks["columnar"]
+    print(f"Columnar peaks {ratio:.1f}x lower than reamber")
+
+    sys.exit(0 if ratio >= args.min_ratio else 1)
+
+
+if __name__ == '__main__':
+    main()
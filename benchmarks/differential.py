@@ -0,0 +1,150 @@
+"""Checks that the direct conversion writes the same .osu files as reamber
+
+Converts every .qua of a corpus with both `convertQua()` and
+`convertQuaDirect()` for several option sets and compares the bytes.
+Also reports the time both paths took. Without a corpus, synthetic maps
+and edge cases are used. Exits with 1 if any output differs.
+
+Run with `py benchmarks/differential.py path/to/songs`
+"""
+
+# ## Imports
+
+import argparse  # parsing command line arguments
+import itertools  # to build all option combinations
+import os  # for paths and directories
+import sys  # to make the root modules importable
+import time  # to measure execution time
+import zipfile  # to read .qua files out of .qp files
+
+import yaml  # to build the edge cases
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from conversion import SAMPLESETS, convertQua, convertQuaDirect  # noqa: E402
+from synthetic import makeQua  # noqa: E402
+
+# ## Constants
+
+OPTION_SETS = [
+    {"od": od, "hp": hp, "hitSoundVolume": volume, "sampleSet": sampleSet, "creator": creator}
+    for od, hp, volume, sampleSet, creator in itertools.product(
+        [0, 8, 7.5], [0, 8], [0, 20], ["", *SAMPLESETS], [None, "someone"]
+    )
+]
+
+# ## Classes
+
+
+class IndentedDumper(yaml.SafeDumper):
+    """Indents block lists under their key, which is valid YAML but not how Quaver writes them"""
+
+    def increase_indent(self, flow=False, indentless=False):
+        return super().increase_indent(flow, False)
+
+# ## Functions
+
+
+def edgeCases():
+    """Yields synthetic maps that cover the less common parts of the format"""
+
+    for keys in [4, 7]:
+        yield f"synthetic {keys}K", makeQua("Synthetic", notes=2000, svs=500, keys=keys, seed=keys).encode()
+
+    qua = yaml.safe_load(makeQua("Floats", notes=200, svs=50))
+    for i, note in enumerate(qua["HitObjects"]):
+        note["StartTime"] += 0.1 * i
+        if "EndTime" in note:
+            note["EndTime"] += 0.3
+    for sv in qua["SliderVelocities"]:
+        sv["StartTime"] += 0.5
+    qua["TimingPoints"][0]["StartTime"] = 12.345
+    yield "float offsets", yaml.safe_dump(qua, sort_keys=False).encode()
+
+    qua["Mode"] = "Keys8"
+    qua["Title"] = "ユニコード"
+    yield "8K unicode", yaml.safe_dump(qua, sort_keys=False, allow_unicode=True).encode()
+
+    for i, note in enumerate(qua["HitObjects"][::3]):
+        note["KeySounds"] = [{"Sample": i % 3 + 1, "Volume": 100}]
+    keySounds = yaml.safe_dump(qua, sort_keys=False, allow_unicode=True)
+    yield "nested key sounds", keySounds.encode()
+    yield "CRLF line endings", keySounds.replace("\n", "\r\n").encode()
+    yield "YAML loader fallback", keySounds.replace("Lane: 1\n", "Lane: 0x1 # hex\n", 1).encode()
+    yield "indented block lists", yaml.dump(qua, Dumper=IndentedDumper, sort_keys=False, allow_unicode=True).encode()
+
+    qua["HitObjects"] = []
+    qua["SliderVelocities"] = []
+    yield "empty", yaml.safe_dump(qua, sort_keys=False).encode()
+
+
+def corpus(paths: list):
+    """Yields the name and content of each .qua file in the given paths"""
+
+    for root in paths:
+        for directory, dirs, files in os.walk(root):
+            for file in sorted(files):
+                path = os.path.join(directory, file)
+                if file.endswith(".qua"):
+                    with open(path, "rb") as quaFile:
+                        yield path, quaFile.read()
+                elif file.endswith(".qp"):
+                    try:
+                        with zipfile.ZipFile(path) as qp:
+                            for name in qp.namelist():
+                                if name.endswith(".qua"):
+                                    yield f"{path}/{name}", qp.read(name)
+                    except zipfile.BadZipFile:
+                        print(f"Skipping {path}: not a zip file")
+
+
+def firstDifference(expected: str, actual: str) -> str:
+    for number, (expectedLine, actualLine) in enumerate(zip(expected.split("\n"), actual.split("\n")), 1):
+        if expectedLine != actualLine:
+            return f"line {number}: {expectedLine!r} != {actualLine!r}"
+    return "different length"
+
+
+def main():
+    argParser = argparse.ArgumentParser("Compares the direct conversion with the reamber conversion")
+    argParser.add_argument("corpus", help="Directories with .qp or .qua files", nargs="*")
+    args = argParser.parse_args()
+
+    maps = corpus(args.corpus) if args.corpus else edgeCases()
+
+    checked = 0
+    mismatches = 0
+    reamberTime = 0
+    directTime = 0
+
+    for name, data in maps:
+        for options in OPTION_SETS:
+            start = time.perf_counter()
+            try:
+                expected = convertQua(data, options)
+            except Exception as e:
+                # Maps that reamber can't read aren't part of the comparison
+                print(f"Skipping {name}: {e!r}")
+                break
+            reamberTime += time.perf_counter() - start
+
+            start = time.perf_counter()
+            try:
+                actual = convertQuaDirect(data, options)
+            except Exception as e:
+                actual = repr(e)
+            directTime += time.perf_counter() - start
+
+            checked += 1
+            if expected != actual:
+                mismatches += 1
+                print(f"Mismatch in {name} with {options}: {firstDifference(expected, actual)}")
+
+    print(f"Compared {checked} conversions, {mismatches} mismatches")
+    print(f"reamber: {reamberTime:.2f} s, direct: {directTime:.2f} s")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
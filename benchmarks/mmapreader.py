@@ -0,0 +1,104 @@
+"""Benchmarks reading a .qp archive with `zipfile` and with `MappedZipFile`
+
+Reads every .qua member and copies every other member raw into an archive
+in memory, like `convertQp()` does minus the conversion itself. The cold
+case drops the .qp from the page cache before each repeat, which needs
+`os.posix_fadvise()` (Linux), the warm case reads it from memory.
+Run with `py benchmarks/mmapreader.py --audio-size 256`
+"""
+
+# ## Imports
+
+import argparse  # parsing command line arguments
+import io  # to write the new archive to memory instead of the disk
+import os  # for paths and directories
+import statistics  # for the median of the repeats
+import sys  # to make the root modules importable
+import tempfile  # to keep the generated mapsets out of the way
+import time  # to measure execution time
+import zipfile  # to handle .zip files (.qua and .osz)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from archive import MappedZipFile, copyMember  # noqa: E402
+from synthetic import makeQp  # noqa: E402
+
+# ## Constants
+
+READERS = {
+    "zipfile": lambda path: zipfile.ZipFile(path, "r"),
+    "mmap": MappedZipFile
+}
+
+# ## Functions
+
+
+def dropPageCache(path: str) -> None:
+    """Evicts the pages of a file from the page cache, so the next read comes from the disk"""
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def readArchive(openReader, path: str) -> None:
+    with openReader(path) as source, zipfile.ZipFile(io.BytesIO(), "w") as target:
+        for info in source.infolist():
+            if info.filename.endswith(".qua"):
+                source.read(info)
+            else:
+                copyMember(source, info, target)
+
+
+def timeReader(openReader, path: str, repeats: int, cold: bool) -> float:
+    """Returns the median time of all repeats of reading the archive"""
+
+    times = []
+
+    # Makes sure the warm repeats find the whole file in memory
+    if not cold:
+        readArchive(openReader, path)
+
+    for _ in range(repeats):
+        if cold:
+            dropPageCache(path)
+        start = time.perf_counter()
+        readArchive(openReader, path)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def main():
+    argParser = argparse.ArgumentParser("Benchmarks the .qp readers of convertQp")
+    argParser.add_argument("--audio-size", help="Audio size in MiB, defaults to 256", default=256, type=int)
+    argParser.add_argument("--difficulties", help="Difficulties in the mapset, defaults to 10", default=10, type=int)
+    argParser.add_argument("--repeats", help="Repeats per reader and case, defaults to 5", default=5, type=int)
+    argParser.add_argument("--dir", help="Folder for the generated mapset, e.g. on the slow disk that should be tested, "
+                                         "defaults to a temporary folder")
+    args = argParser.parse_args()
+
+    cases = ["warm"]
+    if hasattr(os, "posix_fadvise"):
+        cases.insert(0, "cold")
+    else:
+        print("Can't drop files from the page cache on this platform, only measuring the warm case")
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        qpPath = makeQp(os.path.join(directory, "mapset.qp"), difficulties=args.difficulties, notes=5000,
+                        audioSize=args.audio_size * 1024 * 1024)
+        size = os.path.getsize(qpPath) / 1024 / 1024
+
+        print(f"Mapset size: {size:.1f} MiB, median of {args.repeats}")
+
+        for case in cases:
+            for name, openReader in READERS.items():
+                elapsed = timeReader(openReader, qpPath, args.repeats, case == "cold")
+                print(f"{case:>5} {name:>8}: {elapsed * 1000:8.1f} ms  {size / elapsed:8.1f} MiB/s")
+
+
+if __name__ == '__main__':
+    main()
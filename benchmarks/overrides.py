@@ -0,0 +1,60 @@
+"""Benchmarks overriding the hitsound volume and sample set of all timing points
+
+Compares the previous per-object loop with `applyOptions()` on a map with
+many SVs. Run with `py benchmarks/overrides.py --svs 50000`
+"""
+
+# ## Imports
+
+import argparse  # parsing command line arguments
+import os  # for paths and directories
+import sys  # to make the root modules importable
+import timeit  # to measure execution time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from reamber.algorithms.convert import QuaToOsu  # noqa: E402
+
+from conversion import SAMPLESETS, applyOptions, readQua  # noqa: E402
+from synthetic import makeQua  # noqa: E402
+
+OPTIONS = {
+    "od": 8,
+    "hp": 8,
+    "hitSoundVolume": 20,
+    "sampleSet": "Soft",
+    "creator": None
+}
+
+# ## Functions
+
+
+def perObject(convertedOsu, options):
+    """The override loop as it was before, looks up the options for every timing point"""
+
+    for list in [convertedOsu.bpms.data(), convertedOsu.svs.data()]:
+        for element in list:
+            if options["hitSoundVolume"]:
+                element.volume = options["hitSoundVolume"]
+            if options["sampleSet"]:
+                element.sampleSet = SAMPLESETS.index(options["sampleSet"])
+
+
+def main():
+    argParser = argparse.ArgumentParser("Benchmarks the timing point overrides of convertQp")
+    argParser.add_argument("--svs", help="Amount of SVs, defaults to 50000", default=50000, type=int)
+    argParser.add_argument("--repeats", help="Repeats per variant, defaults to 20", default=20, type=int)
+    args = argParser.parse_args()
+
+    convertedOsu = QuaToOsu.convert(readQua(makeQua("Benchmark", svs=args.svs).encode()))
+    timingPoints = len(convertedOsu.bpms) + len(convertedOsu.svs)
+
+    print(f"{timingPoints} timing points, best of {args.repeats}")
+
+    for function in [perObject, applyOptions]:
+        elapsed = min(timeit.repeat(lambda: function(convertedOsu, OPTIONS), number=1, repeat=args.repeats))
+        print(f"{function.__name__:>12}: {elapsed * 1000:8.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Benchmarks copying the non-.qua members of a mapset into a new archive
+
+Compares recompressing every member, decompressing and storing it and
+passing the compressed bytes through unchanged (what `convertQp()` does).
+Run with `py benchmarks/passthrough.py --audio-size 64`
+"""
+
+# ## Imports
+
+import argparse  # parsing command line arguments
+import os  # for paths and directories
+import shutil  # to copy files between archives in chunks
+import sys  # to make the root modules importable
+import tempfile  # to keep the generated mapsets out of the way
+import time  # to measure execution time
+import zipfile  # to handle .zip files (.qua and .osz)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from archive import COPY_CHUNK_SIZE, copyMember  # noqa: E402
+from synthetic import makeQp  # noqa: E402
+
+# ## Strategies
+
+
+def recompress(source, info, target):
+    """Decompresses the member and deflates it again"""
+
+    newInfo = zipfile.ZipInfo(info.filename, info.date_time)
+    newInfo.compress_type = zipfile.ZIP_DEFLATED
+    with source.open(info) as sourceFile, target.open(newInfo, "w") as targetFile:
+        shutil.copyfileobj(sourceFile, targetFile, COPY_CHUNK_SIZE)
+
+
+def store(source, info, target):
+    """Decompresses the member and stores it uncompressed"""
+
+    copyMember(source, info, target, raw=False)
+
+
+def passthrough(source, info, target):
+    """Copies the compressed bytes as they are"""
+
+    copyMember(source, info, target)
+
+
+STRATEGIES = [recompress, store, passthrough]
+
+# ## Functions
+
+
+def timeStrategy(strategy, qpPath: str, outputPath: str, repeats: int) -> float:
+    """Returns the best time out of all repeats of building the archive"""
+
+    best = float("inf")
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with zipfile.ZipFile(qpPath, "r") as source, zipfile.ZipFile(outputPath, "w") as target:
+            for info in source.infolist():
+                if not info.filename.endswith(".qua"):
+                    strategy(source, info, target)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    argParser = argparse.ArgumentParser("Benchmarks the archive building of convertQp")
+    argParser.add_argument("--audio-size", help="Audio size in MiB, defaults to 64", default=64, type=int)
+    argParser.add_argument("--repeats", help="Repeats per strategy, defaults to 5", default=5, type=int)
+    args = argParser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        qpPath = makeQp(os.path.join(directory, "mapset.qp"), audioSize=args.audio_size * 1024 * 1024)
+        outputPath = os.path.join(directory, "mapset.osz")
+        size = os.path.getsize(qpPath) / 1024 / 1024
+
+        print(f"Mapset size: {size:.1f} MiB, best of {args.repeats}")
+
+        for strategy in STRATEGIES:
+            elapsed = timeStrategy(strategy, qpPath, outputPath, args.repeats)
+            print(f"{strategy.__name__:>12}: {elapsed * 1000:8.1f} ms  {size / elapsed:8.1f} MiB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Startup time of the command-line tool
+
+Times `qua2osu.py --help` and a run on an empty folder, which never
+convert anything and shouldn't pay for importing reamber, pandas and numpy.
+Fails if the median of a run exceeds the budget or if one of the heavy
+modules gets imported anyway, so it can guard against a stray top-level import.
+
+Run with `py benchmarks/startup.py --budget 0.3`
+"""
+
+# ## Imports
+
+import argparse  # parsing command line arguments
+import os  # for paths and directories
+import statistics  # for the median of the runs
+import subprocess  # to start the command-line tool like a user would
+import sys  # for the path of the interpreter
+import tempfile  # for the empty input folder
+import time  # to measure execution time
+
+# ## Constants
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Modules that must only be imported once a .qua file is converted
+HEAVY_MODULES = ["yaml", "reamber", "pandas", "numpy"]
+
+# ## Functions
+
+
+def timeRun(arguments: list) -> tuple:
+    """Runs the command-line tool, returns the elapsed time and the imported top-level modules"""
+
+    command = [sys.executable, "-X", "importtime", os.path.join(ROOT, "qua2osu.py"), *arguments]
+
+    start = time.perf_counter()
+    process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+
+    # Lines look like "import time:   self [us] |  cumulative | package.module"
+    modules = set()
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+
+    return elapsed, modules
+
+
+def main():
+    argParser = argparse.ArgumentParser("Benchmarks the startup time of the command-line tool")
+    argParser.add_argument("--budget", help="Maximum median time of a run in seconds, defaults to 0.3",
+                           default=0.3, type=float)
+    argParser.add_argument("--repeats", help="Runs of each case, defaults to 10", default=10, type=int)
+    args = argParser.parse_args()
+
+    ok = True
+
+    with tempfile.TemporaryDirectory() as directory:
+        cases = {
+            "help": ["--help"],
+            "emptyInput": [directory, "-o", directory, "--no-cache"]
+        }
+
+        for name, arguments in cases.items():
+            runs = [timeRun(arguments) for _ in range(args.repeats)]
+            median = statistics.median(elapsed for elapsed, modules in runs)
+            heavy = sorted(set(HEAVY_MODULES) & set.union(*(modules for elapsed, modules in runs)))
+
+            overBudget = median > args.budget
+            ok = ok and not overBudget and not heavy
+
+            print(f"{name:<12} {median * 1000:8.1f} ms{'  OVER BUDGET' if overBudget else ''}")
+            if heavy:
+                print(f"{'':<12} imported {', '.join(heavy)}")
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Benchmark suite of the whole conversion
+
+Generates synthetic mapsets, times each stage of `convertQp()` with its
+stage timers as well as complete `main()` runs and writes the results as JSON. Pass a
+previous result with --compare to catch regressions between versions.
+
+Run with `py benchmarks/suite.py --output results.json`
+"""
+
+# ## Imports
+
+import argparse  # parsing command line arguments
+import contextlib  # to silence the command-line tool
+import io  # to silence the command-line tool
+import json  # to write and compare the results
+import os  # for paths and directories
+import platform  # to describe the machine in the results
+import sys  # to make the root modules importable
+import tempfile  # to keep the generated mapsets out of the way
+import time  # to measure execution time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import qua2osu  # noqa: E402
+from conversion import convertQp  # noqa: E402
+from profiling import StageTimer  # noqa: E402
+from synthetic import makeQp  # noqa: E402
+
+# ## Constants
+
+OPTIONS = {
+    "od": 8,
+    "hp": 8,
+    "hitSoundVolume": 20,
+    "sampleSet": "Soft",
+    "creator": None
+}
+
+# ## Functions
+
+
+def timeStages(qpPath: str, outputFolder: str, options) -> dict:
+    """Converts a mapset with the stage timers of `convertQp()` and returns their times"""
+
+    timer = StageTimer()
+    outputPath = convertQp(qpPath, outputFolder, options, timer)
+
+    with timer.stage("cleanup"):
+        os.remove(outputPath)
+
+    return timer.seconds
+
+
+def runMain(inputFolder: str, outputFolder: str, arguments: list) -> float:
+    """Runs the command-line tool on a folder and returns the elapsed time"""
+
+    sys.argv = ["qua2osu.py", inputFolder, "-o", outputFolder, "--no-cache", *arguments]
+
+    # Doesn't open a file explorer after every run
+    qua2osu.webbrowser.open = lambda url: None
+
+    # Keeps the progress output out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        qua2osu.main()
+        return time.perf_counter() - start
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Prints the change of every timing relative to the baseline, returns False on regressions"""
+
+    ok = True
+
+    for group in ["stages", "endToEnd"]:
+        for name, seconds in results[group].items():
+            if name not in baseline.get(group, {}):
+                continue
+            ratio = seconds / baseline[group][name]
+            regressed = ratio > threshold
+            ok = ok and not regressed
+            print(f"{group}.{name:<12} {ratio:6.2f}x{'  REGRESSION' if regressed else ''}")
+
+    return ok
+
+
+def main():
+    argParser = argparse.ArgumentParser("Benchmarks the conversion of synthetic mapsets")
+    argParser.add_argument("--mapsets", help="Amount of mapsets for the end-to-end runs, defaults to 8", default=8, type=int)
+    argParser.add_argument("--difficulties", help="Difficulties per mapset, defaults to 4", default=4, type=int)
+    argParser.add_argument("--notes", help="Notes per difficulty, defaults to 5000", default=5000, type=int)
+    argParser.add_argument("--svs", help="SVs per difficulty, defaults to 1000", default=1000, type=int)
+    argParser.add_argument("--audio-size", help="Audio size in MiB, defaults to 8", default=8, type=int)
+    argParser.add_argument("--repeats", help="Repeats of each measurement, the best is kept, defaults to 3",
+                           default=3, type=int)
+    argParser.add_argument("--jobs", help="Worker processes of the end-to-end runs, defaults to the CPU count",
+                           default=os.cpu_count() or 1, type=int)
+    argParser.add_argument("--output", help="Path of the JSON results, printed if not given")
+    argParser.add_argument("--compare", help="Path of previous JSON results to compare against")
+    argParser.add_argument("--threshold", help="Slowdown that counts as a regression, defaults to 1.2",
+                           default=1.2, type=float)
+    args = argParser.parse_args()
+
+    parameters = {
+        "mapsets": args.mapsets,
+        "difficulties": args.difficulties,
+        "notes": args.notes,
+        "svs": args.svs,
+        "audioSize": args.audio_size,
+        "repeats": args.repeats,
+        "jobs": args.jobs
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        inputFolder = os.path.join(directory, "input")
+        outputFolder = os.path.join(directory, "output")
+        os.mkdir(inputFolder)
+        os.mkdir(outputFolder)
+
+        for i in range(args.mapsets):
+            makeQp(os.path.join(inputFolder, f"mapset{i}.qp"), args.difficulties, args.notes, args.svs,
+                   args.audio_size * 1024 * 1024)
+
+        # Stages of the reamber conversion and of the direct conversion, prefixed with "fast."
+        qpPath = os.path.join(inputFolder, "mapset0.qp")
+        stages = {}
+        for prefix, options in [("", OPTIONS), ("fast.", {**OPTIONS, "fast": True})]:
+            runs = [timeStages(qpPath, outputFolder, options) for _ in range(args.repeats)]
+            stages.update({prefix + stage: min(run[stage] for run in runs) for stage in runs[0]})
+
+        endToEnd = {
+            "serial": min(runMain(inputFolder, outputFolder, ["-j", "1"]) for _ in range(args.repeats)),
+            "parallel": min(runMain(inputFolder, outputFolder, ["-j", str(args.jobs)]) for _ in range(args.repeats)),
+            "fast": min(runMain(inputFolder, outputFolder, ["-j", str(args.jobs), "--fast"])
+                        for _ in range(args.repeats)),
+            "pipeline": min(runMain(inputFolder, outputFolder, ["-j", str(args.jobs), "--pipeline"])
+                            for _ in range(args.repeats))
+        }
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": parameters,
+        "stages": stages,
+        "endToEnd": endToEnd
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf8") as file:
+            baseline = json.load(file)
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Generates synthetic .qp mapsets for the benchmarks"""
+
+# ## Imports
+
+import os  # for paths and random audio data
+import random  # to spread the notes over the lanes
+import zipfile  # to create the .qp (.zip) archive
+
+import yaml  # to write .qua files
+
+# ## Functions
+
+
+def makeQua(difficultyName: str, notes: int = 1000, svs: int = 100, keys: int = 4, seed: int = 0) -> str:
+    """Creates the content of a .qua file with the given amount of notes and SVs
+
+    Every fourth note is a long note, BPM changes every 250 notes
+    """
+
+    rng = random.Random(seed)
+
+    hitObjects = []
+    for i in range(notes):
+        note = {"StartTime": 1000 + i * 50, "Lane": rng.randint(1, keys), "KeySounds": []}
+        if i % 4 == 0:
+            note["EndTime"] = note["StartTime"] + 40
+        hitObjects.append(note)
+
+    timingPoints = [{"StartTime": 1000 + i * 12500, "Bpm": 120.0 + i} for i in range(notes // 250 + 1)]
+    sliderVelocities = [{"StartTime": 1000 + i * 25, "Multiplier": round(rng.uniform(0.5, 2.0), 2)} for i in range(svs)]
+
+    qua = {
+        "AudioFile": "audio.mp3",
+        "SongPreviewTime": 1000,
+        "BackgroundFile": "bg.jpg",
+        "MapId": -1,
+        "MapSetId": -1,
+        "Mode": f"Keys{keys}",
+        "Title": "Synthetic",
+        "Artist": "qua2osu",
+        "Source": "",
+        "Tags": "",
+        "Creator": "qua2osu",
+        "DifficultyName": difficultyName,
+        "Description": "",
+        "EditorLayers": [],
+        "CustomAudioSamples": [],
+        "SoundEffects": [],
+        "TimingPoints": timingPoints,
+        "SliderVelocities": sliderVelocities,
+        "HitObjects": hitObjects
+    }
+
+    return yaml.safe_dump(qua, default_flow_style=False, sort_keys=False)
+
+
+def makeQp(path: str, difficulties: int = 3, notes: int = 1000, svs: int = 100,
+           audioSize: int = 1024 * 1024, backgroundSize: int = 256 * 1024) -> str:
+    """Creates a .qp mapset with random audio and background data
+
+    Random bytes compress as badly as real .mp3 and .jpg files, all members
+    are deflated like in mapsets exported by Quaver. Returns the path.
+    """
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as qp:
+        for i in range(difficulties):
+            qp.writestr(f"{i}.qua", makeQua(f"Difficulty {i}", notes, svs, seed=i))
+        qp.writestr("audio.mp3", os.urandom(audioSize))
+        qp.writestr("bg.jpg", os.urandom(backgroundSize))
+
+    return path
@@ -0,0 +1,222 @@
+"""Persistent cache of converted mapsets, to skip unchanged mapsets on reruns"""
+
+# ## Imports
+
+import hashlib  # to key the cache by the content of the mapset
+import json  # to serialize the options into the key
+import os  # for paths and directories
+import shutil  # to copy cached files if hardlinks aren't possible
+import tempfile  # to add files to the cache atomically
+import threading  # the pipelined conversion stores from several threads
+
+from archive import createPartial, replacePartial
+
+# ## Constants
+
+# Bump this whenever the conversion output changes, so old entries aren't reused
+CACHE_VERSION = 1
+
+# Default maximum size of the cache in bytes
+DEFAULT_CACHE_SIZE = 2048 * 1024 * 1024
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Options that only choose how a mapset is converted and read, the output is the same either way
+OUTPUT_NEUTRAL_OPTIONS = ("fast", "mmap", "dedupe")
+
+# Each process evicts again once it stored this fraction of the maximum size since its last eviction
+EVICTION_INTERVAL = 16
+
+# Bytes each process stored since it last evicted, by cache directory. Module level,
+# since the `ConversionCache` itself is copied into the worker processes for every task
+storedSizes = {}
+storedSizesLock = threading.Lock()
+
+# ## Functions
+
+
+def defaultCacheDir() -> str:
+    """Returns the platform specific cache directory of qua2osu"""
+
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+
+    return os.path.join(base, "qua2osu")
+
+
+def hashFile(path: str) -> str:
+    """Returns the SHA-256 hex digest of a file"""
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def outputOptions(options) -> dict:
+    """Returns the options without the ones in `OUTPUT_NEUTRAL_OPTIONS`, to tell if outputs are still up to date"""
+
+    return {key: value for key, value in options.items() if key not in OUTPUT_NEUTRAL_OPTIONS}
+
+# ## Classes
+
+
+class ConversionCache:
+    """Content-addressed store of converted .osz files
+
+    Entries are keyed by the hash of the .qp file and the conversion options
+    and evicted least recently used first once the cache grows larger than
+    `maxSize` bytes. `store()` evicts along the way, so the cache only grows
+    past `maxSize` by a fraction of it during a long run. Only consists of
+    plain attributes, so it can be handed to worker processes.
+    """
+
+    def __init__(self, directory: str = None, maxSize: int = DEFAULT_CACHE_SIZE):
+        self.directory = directory or defaultCacheDir()
+        self.maxSize = maxSize
+
+    def key(self, path: str, options, fileHash: str = None) -> str:
+        """Builds the cache key of a mapset converted with the given options"""
+
+        return self.keys(path, [options], fileHash)[0]
+
+    def keys(self, path: str, variants: list, fileHash: str = None) -> list:
+        """Builds the cache keys of a mapset converted with each options in `variants`
+
+        Hashes the mapset only once, or not at all if its `hashFile()` digest
+        is passed as `fileHash`.
+        """
+
+        if fileHash is None:
+            fileHash = hashFile(path)
+        keys = []
+
+        for options in variants:
+            digest = hashlib.sha256()
+            digest.update(str(CACHE_VERSION).encode())
+            digest.update(fileHash.encode())
+            digest.update(json.dumps(outputOptions(options), sort_keys=True).encode())
+            keys.append(digest.hexdigest())
+
+        return keys
+
+    def entryPath(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".osz")
+
+    def fetch(self, key: str, outputPath: str) -> bool:
+        """Places the cached .osz at the output path, returns False on a cache miss"""
+
+        entryPath = self.entryPath(key)
+
+        if not os.path.isfile(entryPath):
+            return False
+
+        # Links or copies next to the output first and renames it afterwards,
+        # so that an interrupted run never leaves a half-copied .osz behind
+        temporaryPath = createPartial(outputPath)
+
+        try:
+            # Hardlinks are free, copying is only needed across drives
+            try:
+                os.remove(temporaryPath)
+                os.link(entryPath, temporaryPath)
+            except FileNotFoundError:
+                # Copying a vanished entry would fail just the same
+                raise
+            except OSError:
+                shutil.copyfile(entryPath, temporaryPath)
+
+            replacePartial(temporaryPath, outputPath)
+        except FileNotFoundError:
+            # Another worker evicted the entry since the check above, so it's converted again
+            if os.path.lexists(temporaryPath):
+                os.remove(temporaryPath)
+            return False
+        except BaseException:
+            if os.path.lexists(temporaryPath):
+                os.remove(temporaryPath)
+            raise
+
+        # Marks the entry as recently used for the eviction, unless it was evicted in the meantime
+        try:
+            os.utime(entryPath)
+        except FileNotFoundError:
+            pass
+
+        return True
+
+    def store(self, key: str, outputPath: str) -> None:
+        """Adds a converted .osz to the cache, evicts old entries every now and then"""
+
+        entryPath = self.entryPath(key)
+        os.makedirs(os.path.dirname(entryPath), exist_ok=True)
+
+        # Links or copies to a temporary file first, so that parallel workers
+        # or an interrupted run never leave a half-written entry behind
+        fd, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(entryPath), suffix=".tmp")
+        os.close(fd)
+
+        try:
+            # Hardlinks are free, copying is only needed across drives. The output
+            # is only ever replaced and never written into, see `convertQpVariants()`
+            try:
+                os.remove(temporaryPath)
+                os.link(outputPath, temporaryPath)
+            except OSError:
+                shutil.copyfile(outputPath, temporaryPath)
+            os.replace(temporaryPath, entryPath)
+        except BaseException:
+            if os.path.lexists(temporaryPath):
+                os.remove(temporaryPath)
+            raise
+
+        with storedSizesLock:
+            storedSize = storedSizes.get(self.directory, 0) + os.path.getsize(entryPath)
+            due = storedSize >= self.maxSize // EVICTION_INTERVAL
+            storedSizes[self.directory] = 0 if due else storedSize
+
+        if due:
+            self.evict()
+
+    def evict(self) -> int:
+        """Removes the least recently used entries until the cache fits into `maxSize`
+
+        Returns the amount of removed entries
+        """
+
+        entries = []
+        totalSize = 0
+
+        if not os.path.isdir(self.directory):
+            return 0
+
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".osz"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                totalSize += stat.st_size
+
+        removed = 0
+
+        for mtime, size, path in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            totalSize -= size
+            removed += 1
+
+        return removed
@@ -0,0 +1,218 @@
+"""Compact columnar representation of a difficulty for the direct conversion
+
+The notes, timing points and SVs are kept in NumPy structured arrays
+instead of a Python object (or dict) for each of them, which needs a
+fraction of the memory and leaves nothing for the garbage collector to
+walk through. The overrides of the options and the .osu serializer work
+on whole columns at once.
+"""
+
+# ## Imports
+
+import array  # to collect the columns while the .qua file is parsed
+
+import numpy as np  # for the structured arrays
+
+from conversion import DEFAULT_SAMPLESET, DEFAULT_VOLUME, KEYS, SAMPLESETS, columnToXAxis, parseQua, writeOsuHeader
+
+# ## Constants
+
+# Hits have a NaN length, long notes store their length like reamber does
+NOTE_DTYPE = np.dtype([
+    ("offset", np.float64),
+    ("column", np.int16),
+    ("length", np.float64)
+])
+
+# `integral` tells if the offset was written as an integer, it's written back the same way
+TIMING_POINT_DTYPE = np.dtype([
+    ("offset", np.float64),
+    ("integral", np.bool_),
+    ("bpm", np.float64),
+    ("volume", np.uint8),
+    ("sampleSet", np.uint8)
+])
+
+SV_DTYPE = np.dtype([
+    ("offset", np.float64),
+    ("integral", np.bool_),
+    ("multiplier", np.float64),
+    ("volume", np.uint8),
+    ("sampleSet", np.uint8)
+])
+
+# ## Classes
+
+
+class ColumnCollector:
+    """List-like target for a list section of `parseQua()`, stores each key of the items in a column
+
+    Missing optional keys are stored as NaN, missing required keys raise a
+    KeyError like the direct conversion does.
+    """
+
+    def __init__(self, required: list, optional: list = ()):
+        self.required = required
+        self.optional = optional
+        self.clear()
+
+    def clear(self) -> None:
+        self.columns = {key: array.array("d") for key in [*self.required, *self.optional]}
+        # Whether the first required value of each item was an integer
+        self.integral = array.array("b")
+
+        # Bound methods, since this runs for every single note
+        self.requiredAppends = [(key, self.columns[key].append) for key in self.required]
+        self.optionalAppends = [(key, self.columns[key].append) for key in self.optional]
+
+    def append(self, item: dict) -> None:
+        for key, append in self.requiredAppends:
+            append(item[key])
+        for key, append in self.optionalAppends:
+            append(item.get(key, np.nan))
+
+        self.integral.append(type(item[self.required[0]]) is int)
+
+    def column(self, key: str) -> np.ndarray:
+        return np.frombuffer(self.columns[key], dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.integral)
+
+
+class ColumnarChart:
+    """Notes, timing points and SVs of a .qua file in structured arrays
+
+    `metadata` holds everything else of the .qua file. Raises a ValueError
+    for charts that the arrays can't hold exactly, e.g. with lanes that
+    aren't small integers, those are left to `writeOsuDirect()`.
+    """
+
+    def __init__(self, metadata: dict, notes: ColumnCollector, timingPoints: ColumnCollector,
+                 sliderVelocities: ColumnCollector):
+        self.metadata = metadata
+
+        lanes = notes.column("Lane")
+        if len(lanes) and not (np.all(lanes == np.trunc(lanes)) and lanes.min() >= -32767 and lanes.max() <= 32768):
+            raise ValueError("Lanes that aren't small integers")
+
+        offsets = notes.column("StartTime")
+        ends = notes.column("EndTime")
+
+        self.notes = np.empty(len(notes), NOTE_DTYPE)
+        self.notes["offset"] = offsets
+        self.notes["column"] = lanes - 1
+        # Same float operations as reamber, see `writeOsuDirect()`
+        self.notes["length"] = (offsets + (ends - offsets)) - offsets
+
+        self.timingPoints = np.empty(len(timingPoints), TIMING_POINT_DTYPE)
+        self.timingPoints["offset"] = timingPoints.column("StartTime")
+        self.timingPoints["integral"] = timingPoints.integral
+        self.timingPoints["bpm"] = timingPoints.column("Bpm")
+        self.timingPoints["volume"] = DEFAULT_VOLUME
+        self.timingPoints["sampleSet"] = DEFAULT_SAMPLESET
+
+        self.sliderVelocities = np.empty(len(sliderVelocities), SV_DTYPE)
+        self.sliderVelocities["offset"] = sliderVelocities.column("StartTime")
+        self.sliderVelocities["integral"] = sliderVelocities.integral
+        self.sliderVelocities["multiplier"] = sliderVelocities.column("Multiplier")
+        self.sliderVelocities["volume"] = DEFAULT_VOLUME
+        self.sliderVelocities["sampleSet"] = DEFAULT_SAMPLESET
+
+    @classmethod
+    def parse(cls, data: bytes):
+        """Parses a .qua file straight into the arrays, without keeping a dict for each note"""
+
+        sections = {
+            "HitObjects": ColumnCollector(["StartTime", "Lane"], ["EndTime"]),
+            "TimingPoints": ColumnCollector(["StartTime", "Bpm"]),
+            "SliderVelocities": ColumnCollector(["StartTime", "Multiplier"])
+        }
+
+        qua = parseQua(data, sections)
+        metadata = {key: value for key, value in qua.items() if key not in sections}
+
+        return cls(metadata, sections["HitObjects"], sections["TimingPoints"], sections["SliderVelocities"])
+
+    def applyOptions(self, options) -> None:
+        """Sets the hitsound volume and sample set of all timing points and SVs"""
+
+        volume = options["hitSoundVolume"] or DEFAULT_VOLUME
+        sampleSet = SAMPLESETS.index(options["sampleSet"]) if options["sampleSet"] else DEFAULT_SAMPLESET
+
+        for points in [self.timingPoints, self.sliderVelocities]:
+            points["volume"] = volume
+            points["sampleSet"] = sampleSet
+
+    def write(self, options, stream) -> None:
+        """Writes the .osu text to a text stream, same as `writeOsuDirect()` for the parsed .qua file
+
+        Only od, hp and creator are taken from the options, call
+        `applyOptions()` for the hitsound volume and sample set.
+        """
+
+        keys = KEYS.get(self.metadata["Mode"], -1)
+
+        writeOsuHeader(self.metadata, options, stream)
+
+        for points, values, numerator, kind in [(self.timingPoints, "bpm", 60000.0, 1),
+                                                (self.sliderVelocities, "multiplier", -100.0, 0)]:
+            if np.any(points[values] == 0):
+                raise ZeroDivisionError("float division by zero")
+
+            offsets = offsetsOf(points)
+            lengths = (numerator / points[values]).tolist()
+
+            # After `applyOptions()` all points share the same suffix
+            if len(points) and np.all(points["volume"] == points["volume"][0]) and \
+                    np.all(points["sampleSet"] == points["sampleSet"][0]):
+                suffix = f",4,{points['sampleSet'][0]},0,{points['volume'][0]},{kind},0\n"
+                stream.writelines(map(f"{{}},{{}}{suffix}".format, offsets, lengths))
+            else:
+                stream.writelines(map(
+                    f"{{}},{{}},4,{{}},0,{{}},{kind},0\n".format,
+                    offsets,
+                    lengths,
+                    points["sampleSet"].tolist(),
+                    points["volume"].tolist()
+                ))
+
+        stream.write("\n[HitObjects]\n")
+
+        # Hits are written before long notes, both in the order of the .qua file
+        columns, inverse = np.unique(self.notes["column"], return_inverse=True)
+        xAxes = np.array([columnToXAxis(int(column), keys) for column in columns], dtype=np.int64)[inverse]
+
+        isHit = np.isnan(self.notes["length"])
+        offsets = self.notes["offset"]
+
+        stream.writelines(map(
+            "{},192,{},1,0,0:0:0:0:\n".format,
+            xAxes[isHit].tolist(),
+            offsets[isHit].astype(np.int64).tolist()
+        ))
+
+        holdOffsets = offsets[~isHit]
+        ends = holdOffsets + ((holdOffsets + self.notes["length"][~isHit]) - holdOffsets)
+
+        stream.writelines(map(
+            "{},192,{},128,0,{}:0:0:0:0:\n".format,
+            xAxes[~isHit].tolist(),
+            holdOffsets.astype(np.int64).tolist(),
+            ends.astype(np.int64).tolist()
+        ))
+
+# ## Functions
+
+
+def offsetsOf(points: np.ndarray) -> list:
+    """Returns the offsets of timing points or SVs as integers or floats, like they were in the .qua file"""
+
+    integral = points["integral"]
+
+    if integral.all():
+        return points["offset"].astype(np.int64).tolist()
+    if not integral.any():
+        return points["offset"].tolist()
+
+    return [int(offset) if isInt else offset for offset, isInt in zip(points["offset"].tolist(), integral.tolist())]
@@ -0,0 +1,1172 @@
+"""Conversion engine shared by the command-line tool and the GUI"""
+
+# ## Imports
+
+import collections  # queue of the running conversions
+import concurrent.futures  # process pool for converting several mapsets at once
+import contextlib  # to open the .osz files of all variants at once
+import functools  # to set up the process pools
+import itertools  # to peek at the first tasks
+import multiprocessing  # to hear from the worker processes when they start on a mapset
+import os  # for paths and directories
+import io  # to collect the text of directly converted maps in memory
+import re
+import threading  # to cancel a batch from another thread
+import time  # to measure the time of each conversion
+import traceback  # to report errors of single mapsets without aborting the batch
+import typing  # to annotate with the lazily imported reamber classes
+import zipfile  # to handle .zip files (.qua and .osz)
+
+# yaml and reamber (which pulls in pandas and numpy) are only imported once the
+# first .qua file is converted, so that e.g. --help starts instantly
+if typing.TYPE_CHECKING:
+    from reamber.osu import OsuMap
+    from reamber.quaver import QuaMap
+
+from archive import ArchiveWriter, copyAsset, createPartial, openArchive, replacePartial
+from cache import ConversionCache, hashFile
+from discovery import findQpFiles
+from memory import DIRECT_MEMORY_FACTOR, REAMBER_MEMORY_FACTOR, MemoryBudget, peakMemory, resetPeakMemory
+from profiling import ConversionResult, StageTimer, profiled
+
+# ## Constants
+
+SAMPLESETS = [
+    "Soft",
+    "Normal",
+    "Drum"
+]
+
+# Same defaults as the command-line tool, for options that aren't given
+DEFAULT_OPTIONS = {
+    "od": 8,
+    "hp": 8,
+    "hitSoundVolume": 20,
+    "sampleSet": "Soft",
+    "creator": None,
+    "fast": False,
+    "mmap": False,
+    "compressionLevel": None,
+    "dedupe": False
+}
+
+# Key count of each Quaver game mode, -1 for unknown modes
+KEYS = {
+    "Keys4": 4,
+    "Keys7": 7,
+    "Keys8": 8
+}
+
+# Sections of .qua files that `parseQua()` reads without the YAML loader
+LIST_SECTIONS = ("TimingPoints", "SliderVelocities", "HitObjects")
+
+# Keys in those sections that are used by the direct conversion
+NUMERIC_KEYS = ("StartTime", "EndTime", "Lane", "Bpm", "Multiplier")
+
+# Plain YAML 1.1 numbers, anything fancier (octal, hex, exponents, ...) is left to the YAML loader
+INT_PATTERN = re.compile(r"-?(?:0|[1-9][0-9]*)")
+FLOAT_PATTERN = re.compile(r"-?[0-9]+\.[0-9]+")
+
+# Defaults of reamber's timing points and map metadata
+DEFAULT_VOLUME = 50
+DEFAULT_SAMPLESET = 0
+DEFAULT_HP = 5.0
+DEFAULT_OD = 5.0
+
+# Limits the difficulties converted at the same time with --max-memory,
+# set in each worker process by `setMemoryBudget()`
+memoryBudget = None
+
+# Threads of the current process that compress .osu files, see `compressionPool()`
+compressor = None
+compressorLock = threading.Lock()
+
+# Size of that pool, set by `setCompressionThreads()`, defaults to all CPUs but the converting one
+compressionThreads = None
+
+# Queue that `convertTask()` puts the path of each mapset into when it starts,
+# set in each worker process by `setStartNotices()`, see `StartNotices`
+startNotices = None
+
+# Seconds between two checks for a cancellation while waiting for a difficulty
+CANCEL_POLL_INTERVAL = 0.1
+
+# ## Classes
+
+
+class ConversionCancelled(Exception):
+    """Raised by `convertQpVariants()` when its conversion is cancelled halfway"""
+
+
+class StartNotices:
+    """Calls `onStart` in this process with the path of each mapset that a worker process starts to convert
+
+    The worker processes get `queue` through the initializer of their pool,
+    see `setStartNotices()`, and a thread of this process forwards the paths
+    they put into it. A result can overtake the notice of its worker, so
+    `report()` is also called before handing out each result, whichever of
+    the two comes first reports the start.
+    """
+
+    def __init__(self, onStart):
+        self.onStart = onStart
+        self.queue = multiprocessing.SimpleQueue()
+        self.lock = threading.Lock()
+        # Maps paths to the notices of the workers minus the results reported for them
+        self.balance = collections.Counter()
+        self.thread = threading.Thread(target=self.forward, daemon=True)
+        self.thread.start()
+
+    def forward(self) -> None:
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            self.report(path, True)
+
+    def report(self, path: str, notice: bool = False) -> None:
+        """Reports the start of a mapset, unless the other side already did, `notice` if it comes from a worker"""
+
+        with self.lock:
+            self.balance[path] += 1 if notice else -1
+            first = self.balance[path] > 0 if notice else self.balance[path] < 0
+            if self.balance[path] == 0:
+                del self.balance[path]
+
+        if first:
+            self.onStart(path)
+
+    def close(self) -> None:
+        """Stops forwarding, once the worker processes are shut down"""
+
+        self.queue.put(None)
+        self.thread.join()
+
+# ## Functions
+
+
+def warmUp(options) -> None:
+    """Imports the converter chosen in the options ahead of the first conversion, e.g. in idle worker processes"""
+
+    import yaml  # noqa: F401
+
+    if not options.get("fast"):
+        import reamber.algorithms.convert  # noqa: F401
+
+
+def loadYaml(text):
+    """Parses YAML with the C loader, which is much faster, if PyYAML was built with libyaml"""
+
+    import yaml
+
+    return yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def readQua(data: bytes) -> "QuaMap":
+    """Parses a .qua difficulty from memory
+
+    Same as `QuaMap.readFile()`, but without the need for a file on disk
+    """
+
+    from reamber.quaver import QuaMap
+
+    file = loadYaml(data)
+
+    qua = QuaMap()
+    qua._readNotes(file.pop("HitObjects"))
+    qua._readBpms(file.pop("TimingPoints"))
+    qua._readSVs(file.pop("SliderVelocities"))
+    qua._readMetadata(file)
+
+    return qua
+
+
+def writeOsu(osu: "OsuMap") -> str:
+    """Serializes a converted map to the text of a .osu file
+
+    Same as `OsuMap.writeFile()`, but returns the text instead of writing a file
+    """
+
+    keys = int(osu.circleSize)
+
+    lines = osu.writeStringList()
+
+    lines.append("")
+    lines.append("[TimingPoints]")
+    lines.extend(bpm.writeString() for bpm in osu.bpms)
+    lines.extend(sv.writeString() for sv in osu.svs)
+
+    lines.append("")
+    lines.append("[HitObjects]")
+    lines.extend(hit.writeString(keys=keys) for hit in osu.notes.hits())
+    lines.extend(hold.writeString(keys=keys) for hold in osu.notes.holds())
+
+    return "\n".join(lines) + "\n"
+
+
+def applyOptions(convertedOsu: "OsuMap", options) -> None:
+    """Overrides the map settings of a converted map with the user options"""
+
+    if options["od"]:
+        convertedOsu.overallDifficulty = options["od"]
+    if options["hp"]:
+        convertedOsu.hpDrainRate = options["hp"]
+    if options.get("creator"):
+        convertedOsu.creator = options["creator"]
+
+    # SV heavy maps have tens of thousands of timing points, so the values
+    # are looked up once and each column is set in its own tight loop
+    timingPoints = [convertedOsu.bpms.data(), convertedOsu.svs.data()]
+
+    if options["hitSoundVolume"]:
+        volume = options["hitSoundVolume"]
+        for list in timingPoints:
+            for element in list:
+                element.volume = volume
+
+    if options["sampleSet"]:
+        sampleSet = SAMPLESETS.index(options["sampleSet"])
+        for list in timingPoints:
+            for element in list:
+                element.sampleSet = sampleSet
+
+
+def convertQua(data: bytes, options, timer: StageTimer = None) -> str:
+    """Converts the content of a .qua file to the content of a .osu file
+
+    Uses Evening's reamber package for the conversion itself. Each step is
+    timed by `timer` if one is given.
+    """
+
+    return convertQuaVariants(data, [options], timer)[0]
+
+
+def convertQuaVariants(data: bytes, variants: list, timer: StageTimer = None) -> list:
+    """Converts the content of a .qua file to a .osu file for each options in `variants`
+
+    The .qua file is parsed and converted only once, only the cheap
+    overrides of the options are applied and written for each variant.
+    """
+
+    from reamber.algorithms.convert import QuaToOsu
+
+    timer = timer or StageTimer()
+
+    with timer.stage("parse", len(data)):
+        qua = readQua(data)
+    timer.notes += len(qua.notes.hits()) + len(qua.notes.holds())
+
+    with timer.stage("convert"):
+        convertedOsu = QuaToOsu.convert(qua)
+
+    # Options that a variant leaves unset fall back to these instead of the previous variant's values
+    converted = convertedOsu.overallDifficulty, convertedOsu.hpDrainRate, convertedOsu.creator
+    timingPointDefaults = {"hitSoundVolume": DEFAULT_VOLUME, "sampleSet": SAMPLESETS[DEFAULT_SAMPLESET]}
+
+    texts = []
+    # Volume and sample set that the timing points currently have
+    applied = None
+
+    for options in variants:
+        with timer.stage("overrides"):
+            effective = {key: options[key] or default for key, default in timingPointDefaults.items()}
+            if applied is not None:
+                convertedOsu.overallDifficulty, convertedOsu.hpDrainRate, convertedOsu.creator = converted
+                # The timing points are only looped over again if the variant changes them
+                options = {**options, **{key: None if value == applied[key] else value for key, value in effective.items()}}
+            applyOptions(convertedOsu, options)
+            applied = effective
+
+        with timer.stage("write"):
+            text = writeOsu(convertedOsu)
+        timer.count("write", len(text))
+
+        texts.append(text)
+
+    return texts
+
+
+# ### Direct conversion
+
+
+def columnToXAxis(column: int, keys: int) -> int:
+    """Converts a column starting from 0 to the x coordinate used in .osu files"""
+
+    return int(round(((512.0 * column) + 256.0) / keys))
+
+
+def parseQuaScalar(value: str):
+    """Resolves the numbers used by the direct conversion the same way YAML does"""
+
+    if INT_PATTERN.fullmatch(value):
+        return int(value)
+    if FLOAT_PATTERN.fullmatch(value):
+        return float(value)
+
+    raise ValueError(f"Unexpected value {value!r}")
+
+
+def parseQuaList(lines: list, index: int, items: list = None) -> tuple:
+    """Parses a block list of flat mappings, starting at `lines[index]`
+
+    Only reads what Quaver writes for timing points, SVs and notes. Values
+    of keys that the direct conversion doesn't use are kept as raw strings
+    and their nested blocks (e.g. key sounds) are skipped. Raises a
+    ValueError for anything else. Each item is appended to `items` once
+    it's complete, a new list if none is given. Returns the list and the
+    index of the first line after it.
+    """
+
+    items = [] if items is None else items
+    item = None
+    nestedAllowed = False
+
+    while index < len(lines):
+        line = lines[index].rstrip("\r")
+
+        if line.startswith("- "):
+            if item is not None:
+                items.append(item)
+            item = {}
+            line = line[2:]
+        elif line.strip() == "":
+            index += 1
+            continue
+        elif line.startswith("  ") and item is not None:
+            if line[2] in " -":
+                if not nestedAllowed:
+                    raise ValueError(f"Unexpected nested block in line {index + 1}")
+                index += 1
+                continue
+            line = line[2:]
+        elif line[0] in " \t-":
+            # E.g. an indented block list, which would otherwise end up with the metadata
+            raise ValueError(f"Unexpected line {index + 1}")
+        else:
+            break
+
+        key, separator, value = line.partition(":")
+        if not separator or not key.isalnum():
+            raise ValueError(f"Unexpected line {index + 1}")
+
+        value = value.strip()
+        if key in NUMERIC_KEYS:
+            item[key] = parseQuaScalar(value)
+            nestedAllowed = False
+        else:
+            item[key] = value
+            nestedAllowed = value == ""
+
+        index += 1
+
+    if item is not None:
+        items.append(item)
+
+    return items, index
+
+
+def parseQua(data: bytes, sections: dict = None) -> dict:
+    """Parses a .qua file into the dictionary used by `writeOsuDirect()`
+
+    Same as the YAML loader for everything the direct conversion reads,
+    see `parseQuaList()`. The metadata is left to the YAML loader, but the huge lists of notes,
+    timing points and SVs are read line by line, which is a lot faster.
+    Falls back to the YAML loader for files that aren't laid out like
+    the ones Quaver writes, or whose remaining lines aren't valid YAML on their own.
+
+    `sections` maps list sections to list-like objects with `append()` and
+    `clear()` that take the items of the section instead of a new list,
+    e.g. to store them more compactly, see `ColumnarChart`.
+    """
+
+    import yaml
+
+    sections = sections or {}
+
+    try:
+        lines = data.decode("utf-8-sig").split("\n")
+        lists = {}
+        otherLines = []
+
+        index = 0
+        while index < len(lines):
+            line = lines[index].rstrip("\r")
+            key, separator, value = line.partition(":")
+
+            if separator and key in LIST_SECTIONS:
+                items = sections.get(key, [])
+                items.clear()
+                if value.strip() == "[]":
+                    lists[key] = items
+                    index += 1
+                elif value.strip() == "":
+                    lists[key], index = parseQuaList(lines, index + 1, items)
+                else:
+                    raise ValueError(f"Unexpected value of {key}")
+            else:
+                otherLines.append(line)
+                index += 1
+
+        qua = loadYaml("\n".join(otherLines))
+    except (ValueError, yaml.YAMLError):
+        qua = loadYaml(data)
+
+        # The sections may already hold some items from before the fallback
+        for key, items in sections.items():
+            items.clear()
+            for item in qua[key]:
+                items.append(item)
+            qua[key] = items
+
+        return qua
+
+    qua.update(lists)
+
+    return qua
+
+
+def writeOsuHeader(qua: dict, options, stream) -> None:
+    """Writes the sections of a .osu file up to the timing points for `writeOsuDirect()`
+
+    The user options are applied on the fly, the values that aren't part of
+    the .qua file are the defaults that reamber's `OsuMap` writes
+    """
+
+    keys = KEYS.get(qua["Mode"], -1)
+
+    hp = options["hp"] or DEFAULT_HP
+    od = options["od"] or DEFAULT_OD
+    creator = options.get("creator") or qua["Creator"]
+
+    title = qua["Title"]
+    artist = qua["Artist"]
+
+    stream.write(
+        "osu file format v14\n"
+        "\n"
+        "[General]\n"
+        f"AudioFilename: {qua['AudioFile']}\n"
+        "AudioLeadIn: 0\n"
+        f"PreviewTime: {qua['SongPreviewTime']}\n"
+        "Countdown: 0\n"
+        "SampleSet: 0\n"
+        "StackLeniency: 0.7\n"
+        "Mode: 3\n"
+        "LetterboxInBreaks: 0\n"
+        "SpecialStyle: 0\n"
+        "WidescreenStoryboard: 1\n"
+        "\n"
+        "[Editor]\n"
+        "DistanceSpacing: 4\n"
+        "BeatDivisor: 4\n"
+        "GridSize: 8\n"
+        "TimelineZoom: 0.3\n"
+        "\n"
+        "[Metadata]\n"
+        f"Title:{title}\n"
+        f"TitleUnicode:{title}\n"
+        f"Artist:{artist}\n"
+        f"ArtistUnicode:{artist}\n"
+        f"Creator:{creator}\n"
+        f"Version:{qua['DifficultyName']}\n"
+        "Source:\n"
+        "Tags:\n"
+        "BeatmapID:0\n"
+        "BeatmapSetID:-1\n"
+        "\n"
+        "[Difficulty]\n"
+        f"HPDrainRate:{hp}\n"
+        f"CircleSize:{keys}\n"
+        f"OverallDifficulty:{od}\n"
+        "ApproachRate:5.0\n"
+        "SliderMultiplier:1.4\n"
+        "SliderTickRate:1\n"
+        "\n"
+        "[Events]\n"
+        "//Background and Video events\n"
+        f"0,0,\"{qua['BackgroundFile']}\",0,0\n"
+        "//Break Periods\n"
+        "//Storyboard Layer 0 (Background)\n"
+        "//Storyboard Layer 1 (Fail)\n"
+        "//Storyboard Layer 2 (Pass)\n"
+        "//Storyboard Layer 3 (Foreground)\n"
+        "//Storyboard Layer 4 (Overlay)\n"
+        "//Storyboard Sound Samples\n"
+        "\n"
+        "[TimingPoints]\n"
+    )
+
+
+def writeOsuDirect(qua: dict, options, stream) -> None:
+    """Writes the .osu text of a parsed .qua file to a text stream
+
+    The user options are applied on the fly, see `writeOsuHeader()`
+    """
+
+    keys = KEYS.get(qua["Mode"], -1)
+
+    volume = options["hitSoundVolume"] or DEFAULT_VOLUME
+    sampleSet = SAMPLESETS.index(options["sampleSet"]) if options["sampleSet"] else DEFAULT_SAMPLESET
+
+    writeOsuHeader(qua, options, stream)
+
+    bpmSuffix = f",4,{sampleSet},0,{volume},1,0\n"
+    stream.writelines(
+        f"{bpm['StartTime']},{60000.0 / bpm['Bpm']}{bpmSuffix}"
+        for bpm in qua["TimingPoints"]
+    )
+
+    svSuffix = f",4,{sampleSet},0,{volume},0,0\n"
+    stream.writelines(
+        f"{sv['StartTime']},{-100.0 / sv['Multiplier']}{svSuffix}"
+        for sv in qua["SliderVelocities"]
+    )
+
+    stream.write("\n[HitObjects]\n")
+
+    # Hits are written before long notes, both in the order of the .qua file
+    xAxes = {}
+    hits = []
+    holds = []
+
+    for note in qua["HitObjects"]:
+        lane = note["Lane"]
+        x = xAxes.get(lane)
+        if x is None:
+            x = xAxes[lane] = columnToXAxis(lane - 1, keys)
+
+        offset = note["StartTime"]
+
+        if "EndTime" in note:
+            # Same float operations as reamber, which only stores the length
+            # of long notes, so rounding errors end up the same as well
+            length = (offset + (note["EndTime"] - offset)) - offset
+            end = offset + ((offset + length) - offset)
+            holds.append(f"{x},192,{int(offset)},128,0,{int(end)}:0:0:0:0:\n")
+        else:
+            hits.append(f"{x},192,{int(offset)},1,0,0:0:0:0:\n")
+
+    stream.writelines(hits)
+    stream.writelines(holds)
+
+
+def convertQuaDirect(data: bytes, options, timer: StageTimer = None) -> str:
+    """Converts the content of a .qua file to the content of a .osu file
+
+    Drop-in replacement for `convertQua()` that writes the exact same text,
+    but goes straight from the parsed .qua to the .osu lines without
+    building any reamber map objects
+    """
+
+    return convertQuaDirectVariants(data, [options], timer)[0]
+
+
+def convertQuaDirectVariants(data: bytes, variants: list, timer: StageTimer = None) -> list:
+    """Drop-in replacement for `convertQuaVariants()`, parses the .qua once and writes it with each options
+
+    The notes, timing points and SVs are kept in the compact arrays of a
+    `ColumnarChart`, charts that don't fit into them are written from the
+    parsed .qua with `writeOsuDirect()` instead.
+    """
+
+    # Imported here, since it pulls in numpy
+    from columnar import ColumnarChart
+
+    timer = timer or StageTimer()
+
+    with timer.stage("parse", len(data)):
+        try:
+            chart = ColumnarChart.parse(data)
+            timer.notes += len(chart.notes)
+        except ValueError:
+            chart = None
+            qua = parseQua(data)
+            timer.notes += len(qua.get("HitObjects") or [])
+
+    texts = []
+
+    for options in variants:
+        stream = io.StringIO()
+
+        if chart is None:
+            with timer.stage("write"):
+                writeOsuDirect(qua, options, stream)
+        else:
+            with timer.stage("overrides"):
+                chart.applyOptions(options)
+            with timer.stage("write"):
+                chart.write(options, stream)
+
+        text = stream.getvalue()
+        timer.count("write", len(text))
+        texts.append(text)
+
+    return texts
+
+
+# ### Mapsets
+
+
+def outputPathOf(path: str, outputFolder: str) -> str:
+    """Returns the path of the .osz file that a .qp file is converted to"""
+
+    # Prefixing with "q_" to prevent osu from showing the wrong preview
+    # backgrounds, because it takes the folder number to
+    # choose the background for whatever reason
+    fileName = "q_" + os.path.basename(path).replace(".qp", "") + ".osz"
+
+    return os.path.join(outputFolder, fileName)
+
+
+def setMemoryBudget(budget: MemoryBudget) -> None:
+    """Sets the memory budget of the current process, used as initializer of the process pools"""
+
+    global memoryBudget
+    memoryBudget = budget
+
+
+def setStartNotices(queue: multiprocessing.SimpleQueue) -> None:
+    """Sets the queue of `StartNotices` of the current process, used by the initializers of the process pools"""
+
+    global startNotices
+    startNotices = queue
+
+
+def compressionThreadsBeside(busyProcesses: int, compressingProcesses: int = 1) -> int:
+    """Compression threads for each of `compressingProcesses` processes, with `busyProcesses` converting difficulties"""
+
+    return max(1, (defaultJobs() - busyProcesses) // compressingProcesses)
+
+
+def setCompressionThreads(threads: int) -> None:
+    """Sets the size of the compression pool of the current process, also used as initializer of the process pools"""
+
+    global compressor, compressionThreads
+
+    with compressorLock:
+        if threads == compressionThreads:
+            return
+        compressionThreads = threads
+        # Waits for the members that are still being compressed, the next call starts a pool of the new size
+        if compressor is not None:
+            compressor.shutdown()
+            compressor = None
+
+
+def initWorker(budget: MemoryBudget, threads: int, notices: multiprocessing.SimpleQueue = None) -> None:
+    """Initializer of the process pools of `convertMapsets()`"""
+
+    setMemoryBudget(budget)
+    setCompressionThreads(threads)
+    setStartNotices(notices)
+
+
+def compressionPool() -> concurrent.futures.ThreadPoolExecutor:
+    """Returns the thread pool of the current process that compresses .osu files, see `ArchiveWriter`
+
+    Started on first use and kept for the following mapsets. Its threads
+    only start once there's something to compress.
+    """
+
+    global compressor
+
+    with compressorLock:
+        if compressor is None:
+            compressor = concurrent.futures.ThreadPoolExecutor(max_workers=compressionThreads or compressionThreadsBeside(1))
+        return compressor
+
+
+def convertDifficulty(data: bytes, variants: list) -> tuple:
+    """Converts a single .qua file once for each options in `variants`, with the converter chosen in the options
+
+    Returns the list of encoded .osu files and the timer of the conversion,
+    runs in worker processes when the difficulties of a mapset are converted
+    in parallel. Waits for its estimated memory to fit into the memory budget
+    if there is one.
+    """
+
+    timer = StageTimer()
+
+    if variants[0].get("fast"):
+        convert, factor = convertQuaDirectVariants, DIRECT_MEMORY_FACTOR
+    else:
+        convert, factor = convertQuaVariants, REAMBER_MEMORY_FACTOR
+
+    # Each further variant only adds its .osu text, which is about as large as the .qua
+    size = len(data) * (factor + len(variants) - 1)
+
+    if memoryBudget is None:
+        osuData = [text.encode("utf8") for text in convert(data, variants, timer)]
+    else:
+        with memoryBudget.reserve(size):
+            osuData = [text.encode("utf8") for text in convert(data, variants, timer)]
+
+    timer.peakMemory = peakMemory()
+
+    return osuData, timer
+
+
+def membersOf(oldDir: zipfile.ZipFile) -> list:
+    return [info for info in oldDir.infolist() if not info.is_dir()]
+
+
+def submitDifficulties(oldDir: zipfile.ZipFile, variants: list, executor: concurrent.futures.Executor,
+                       timer: StageTimer = None, profileFolder: str = None) -> dict:
+    """Reads the .qua files of an opened .qp and submits their conversions to `executor`
+
+    Returns the futures of `convertDifficulty()` by the index of the .qua
+    file among the members, for `convertQpVariants()`. The conversions are
+    profiled into `profileFolder` if one is given, see `profiled()`.
+    """
+
+    timer = timer or StageTimer()
+    futures = {}
+
+    for index, info in enumerate(membersOf(oldDir)):
+        if info.filename.endswith(".qua"):
+            with timer.stage("read", info.compress_size):
+                data = oldDir.read(info)
+            if profileFolder is None:
+                futures[index] = executor.submit(convertDifficulty, data, variants)
+            else:
+                futures[index] = executor.submit(profiled, profileFolder, convertDifficulty, data, variants)
+
+    return futures
+
+
+def waitForDifficulty(future: concurrent.futures.Future, cancel: threading.Event = None) -> tuple:
+    """Returns the result of a `convertDifficulty()` in an executor, raises `ConversionCancelled` if cancelled first"""
+
+    while cancel is not None:
+        done, notDone = concurrent.futures.wait([future], timeout=CANCEL_POLL_INTERVAL)
+        if done:
+            break
+        if cancel.is_set():
+            raise ConversionCancelled()
+
+    return future.result()
+
+
+def convertQp(path: str, outputFolder: str, options, timer: StageTimer = None,
+              executor: concurrent.futures.Executor = None, source=None, futures: dict = None) -> str:
+    """Converts a whole .qp mapset to a .osz mapset
+
+    Streams all files of the .qp straight into the new .osz without
+    extracting anything to disk, .qua files are converted to .osu files
+    on the way. Returns the path of the created .osz file. The time and
+    bytes of each stage are recorded in `timer` if one is given. The
+    difficulties are converted in parallel if an `executor` is given.
+    `source` is a file object with the content of the .qp, e.g. one that
+    was read ahead into memory, the file at `path` is opened otherwise.
+    `futures` are the conversions of its difficulties if they were already
+    submitted with `submitDifficulties()`.
+
+    Options parameter is built up as following:
+
+        options = {
+            "od": int,
+            "hp": int,
+            "hitSoundVolume": int,
+            "sampleSet": ["Soft","Normal","Drum"],
+            "creator": str,
+            "fast": bool,  # optional, uses `convertQuaDirect()` instead of reamber
+            "mmap": bool,  # optional, reads the .qp through a memory map, see `MappedZipFile`
+            "compressionLevel": int,  # optional, see `ArchiveWriter`, 0 stores everything uncompressed
+            "dedupe": bool  # optional, hashes the copied assets for `formatDedupeReport()`
+        }
+    """
+
+    return convertQpVariants(path, [(outputFolder, options)], timer, executor, source, futures)[0]
+
+
+def convertQpVariants(path: str, outputs: list, timer: StageTimer = None,
+                      executor: concurrent.futures.Executor = None, source=None, futures: dict = None,
+                      cancel: threading.Event = None) -> list:
+    """Converts a .qp mapset to several .osz mapsets with different options in a single pass
+
+    `outputs` is a list of `(outputFolder, options)` tuples, all options
+    have to use the same converter and reader. Each .qua file is only read, parsed and
+    converted once, see `convertQuaVariants()`, the other files are copied
+    into every .osz. Returns the paths of the created .osz files, see
+    `convertQp()` for the other parameters.
+
+    Setting `cancel` stops the conversion before the next file of the
+    mapset, the difficulties that weren't started yet are dropped and
+    `ConversionCancelled` is raised. No .osz is left behind then.
+    """
+
+    variants = [options for outputFolder, options in outputs]
+    for key in ["fast", "mmap"]:
+        if len({bool(options.get(key)) for options in variants}) > 1:
+            raise ValueError(f"All variants of a mapset have to use the same {key} option")
+
+    outputPaths = [outputPathOf(path, outputFolder) for outputFolder, options in outputs]
+    partialPaths = []
+    timer = timer or StageTimer()
+
+    try:
+        for outputPath in outputPaths:
+            partialPaths.append(createPartial(outputPath))
+
+        # Opens the .qp (.zip) mapset file and creates the new .osz (.zip) mapset files
+        with contextlib.ExitStack() as stack:
+            if source is None:
+                oldDir = stack.enter_context(openArchive(path, variants[0].get("mmap", False)))
+            else:
+                oldDir = stack.enter_context(zipfile.ZipFile(source, "r"))
+            newDirs = [stack.enter_context(zipfile.ZipFile(partialPath, "w")) for partialPath in partialPaths]
+
+            # Compresses the .osu files in parallel threads while the next difficulties are converted
+            pool = compressionPool() if any(options.get("compressionLevel") for options in variants) else None
+            writers = [ArchiveWriter(newDir, options.get("compressionLevel"), pool)
+                       for newDir, options in zip(newDirs, variants)]
+            members = membersOf(oldDir)
+
+            # With an executor all difficulties are converted at the same time,
+            # the .osz is still written in the original order afterwards
+            if futures is None:
+                futures = {} if executor is None else submitDifficulties(oldDir, variants, executor, timer)
+
+            for index, info in enumerate(members):
+                if cancel is not None and cancel.is_set():
+                    raise ConversionCancelled()
+
+                # Replaces each .qua file with the converted .osu file
+                if info.filename.endswith(".qua"):
+                    newFileName = re.sub(r"\.qua$", ".osu", info.filename, 1, re.MULTILINE)
+
+                    if index not in futures:
+                        with timer.stage("read", info.compress_size):
+                            data = oldDir.read(info)
+                        osuData, difficultyTimer = convertDifficulty(data, variants)
+                        del data
+                    else:
+                        osuData, difficultyTimer = waitForDifficulty(futures.pop(index), cancel)
+
+                    timer.merge(difficultyTimer)
+
+                    for writer, variantData in zip(writers, osuData):
+                        with timer.stage("archive", len(variantData)):
+                            writer.writestr(newFileName, variantData)
+
+                    # Doesn't keep the difficulty around while the next one is converted
+                    del osuData, variantData
+
+                # Copies everything else (audio, backgrounds, ...) without recompressing it,
+                # it's only read once for all variants
+                else:
+                    with timer.stage("archive", info.compress_size * len(writers)):
+                        asset = copyAsset(oldDir, info, writers, variants[0].get("dedupe", False))
+
+                    timer.count("assets", info.compress_size)
+                    if asset is not None:
+                        timer.assets.append(asset)
+
+            for writer in writers:
+                with timer.stage("archive"):
+                    writer.flush()
+                timer.count("osu", writer.size)
+                timer.count("osuCompressed", writer.compressedSize)
+    except BaseException:
+        # Drops the difficulties that weren't started yet
+        for future in (futures or {}).values():
+            future.cancel()
+
+        # Doesn't leave broken .osz files behind
+        for partialPath in partialPaths:
+            if os.path.exists(partialPath):
+                os.remove(partialPath)
+        raise
+
+    # Only complete files ever show up under the final names, even if the process gets killed.
+    # Replacing only swaps the directory entry, so old files that are hardlinks into the
+    # conversion cache stay intact, and a failed conversion leaves the previous file alone
+    for partialPath, outputPath in zip(partialPaths, outputPaths):
+        replacePartial(partialPath, outputPath)
+
+    return outputPaths
+
+# ### Batch conversion
+
+
+def variantOutputs(outputFolder: str, options, variants: dict = None) -> list:
+    """Returns the `(outputFolder, options)` of each variant for `convertQpVariants()`
+
+    `variants` maps the name of each variant to the options it overrides,
+    each variant goes into a subfolder with its name. Without variants
+    there's only the mapset itself.
+    """
+
+    if variants is None:
+        return [(outputFolder, options)]
+
+    return [(os.path.join(outputFolder, name), {**options, **overrides}) for name, overrides in variants.items()]
+
+
+def convertTask(path: str, outputFolder: str, options, cache: ConversionCache = None,
+                profileFolder: str = None, executor: concurrent.futures.Executor = None,
+                variants: dict = None, cancel: threading.Event = None) -> ConversionResult:
+    """Runs `convertQp()` for a single mapset and catches any error
+
+    Skips the conversion if the cache already contains the converted mapset.
+    Errors end up in the returned result, so that one broken mapset can't
+    abort the rest of the batch. Dumps a cProfile profile of the conversion
+    into `profileFolder` if one is given. `executor` is passed on to
+    `convertQp()` to convert the difficulties in parallel. With `variants`
+    the mapset is converted once for each variant, see `variantOutputs()`.
+    Only `ConversionCancelled` is raised, once `cancel` is set.
+    """
+
+    if profileFolder is not None:
+        return profiled(profileFolder, convertTask, path, outputFolder, options, cache, None, executor, variants,
+                        cancel)
+
+    if startNotices is not None:
+        startNotices.put(path)
+
+    outputs = variantOutputs(outputFolder, options, variants)
+    outputPaths = [outputPathOf(path, folder) for folder, variantOptions in outputs]
+
+    timer = StageTimer()
+    result = ConversionResult(path, outputPaths[0], outputPaths=None if variants is None else outputPaths)
+    start = time.perf_counter()
+    resetPeakMemory()
+
+    try:
+        if variants is not None:
+            for folder, variantOptions in outputs:
+                os.makedirs(folder, exist_ok=True)
+
+        if cache is None:
+            convertQpVariants(path, outputs, timer, executor, cancel=cancel)
+        else:
+            with timer.stage("cache"):
+                # Handed back in the result, so that e.g. --sync doesn't need to hash the mapset again
+                result.sourceHash = hashFile(path)
+                keys = cache.keys(path, [variantOptions for folder, variantOptions in outputs], result.sourceHash)
+                missing = [index for index, key in enumerate(keys) if not cache.fetch(key, outputPaths[index])]
+                result.cached = not missing
+
+            # Only the variants that aren't cached yet are converted
+            if missing:
+                convertQpVariants(path, [outputs[index] for index in missing], timer, executor, cancel=cancel)
+                with timer.stage("cache"):
+                    for index in missing:
+                        cache.store(keys[index], outputPaths[index])
+    except ConversionCancelled:
+        raise
+    except Exception:
+        result.error = traceback.format_exc()
+        result.outputPath = None
+        result.outputPaths = None
+
+    result.elapsed = time.perf_counter() - start
+    result.stages = timer.seconds
+    result.sizes = timer.sizes
+    result.notes = timer.notes
+    result.assets = timer.assets
+
+    # The difficulties may have been converted in other processes
+    peaks = [peak for peak in [peakMemory(), timer.peakMemory] if peak is not None]
+    result.peakMemory = max(peaks, default=None)
+
+    return result
+
+
+def futureResult(path: str, future: concurrent.futures.Future) -> ConversionResult:
+    """Returns the result of a `convertTask()` that ran in an executor"""
+
+    try:
+        return future.result()
+    except Exception:
+        # The worker process itself died (e.g. out of memory)
+        return ConversionResult(path, error=traceback.format_exc())
+
+
+def defaultJobs() -> int:
+    """Number of worker processes used when none are specified"""
+
+    return os.cpu_count() or 1
+
+
+def convertMapsets(tasks, options, jobs: int = None, cache: ConversionCache = None, profileFolder: str = None,
+                   maxMemory: int = None, cancel: threading.Event = None, variants: dict = None, onStart=None):
+    """Converts multiple mapsets, spread over a pool of worker processes
+
+    `tasks` is an iterable of `(path, outputFolder)` tuples, it may be a
+    generator that is still discovering mapsets, each task is started as
+    soon as it comes in. `jobs` is the amount of worker processes and
+    defaults to the CPU count. A single job converts in the current process
+    without starting a pool. If there's only a single task, its difficulties
+    are spread over the worker processes instead. Unchanged mapsets are
+    taken from `cache` if one is given, see `convertTask()` for `profileFolder`
+    and `variants`.
+    `maxMemory` limits the estimated memory in bytes of the difficulties that
+    all worker processes convert at the same time. `onStart` is called with
+    the path of each mapset once its conversion actually starts, which may
+    be from another thread, see `StartNotices`.
+
+    Setting `cancel` stops the batch, mapsets that haven't been started yet
+    are dropped and only the ones that are already being converted in the
+    worker processes are finished and yielded. Mapsets converted in the
+    current process, e.g. a single large pack, are stopped right away,
+    see `convertQpVariants()`, and aren't yielded.
+
+    Yields a `ConversionResult` for each task in the order of `tasks`
+    """
+
+    if jobs is None:
+        jobs = defaultJobs()
+
+    # More processes than mapsets would only idle, a single mapset is handled below
+    if isinstance(tasks, (list, tuple)) and len(tasks) > 1:
+        jobs = min(jobs, len(tasks))
+
+    budget = None if maxMemory is None else MemoryBudget(maxMemory)
+    cancel = cancel or threading.Event()
+
+    # Every worker process gets the shared budget when it starts, and as many compression
+    # threads as the CPUs that aren't busy with converting leave for it
+    pool = functools.partial(concurrent.futures.ProcessPoolExecutor, initializer=initWorker)
+    threads = compressionThreadsBeside(jobs, jobs)
+
+    if jobs <= 1:
+        setCompressionThreads(compressionThreadsBeside(1))
+        setMemoryBudget(budget)
+        try:
+            for path, outputFolder in tasks:
+                if cancel.is_set():
+                    return
+                if onStart is not None:
+                    onStart(path)
+                yield convertTask(path, outputFolder, options, cache, profileFolder, None, variants, cancel)
+        except ConversionCancelled:
+            return
+        finally:
+            setMemoryBudget(None)
+        return
+
+    # A single mapset can only be sped up by converting its difficulties in parallel
+    tasks = iter(tasks)
+    firstTasks = list(itertools.islice(tasks, 2))
+
+    if cancel.is_set():
+        return
+
+    if len(firstTasks) == 1:
+        path, outputFolder = firstTasks[0]
+        # Only this process compresses, while the worker processes convert the difficulties
+        setCompressionThreads(compressionThreadsBeside(jobs))
+        if onStart is not None:
+            onStart(path)
+        with pool(max_workers=jobs, initargs=(budget, threads)) as executor:
+            try:
+                result = convertTask(path, outputFolder, options, cache, profileFolder, executor, variants, cancel)
+            except ConversionCancelled:
+                return
+        yield result
+        return
+
+    tasks = itertools.chain(firstTasks, tasks)
+
+    notices = None if onStart is None else StartNotices(onStart)
+
+    def finished(path, future):
+        result = futureResult(path, future)
+        # The start is reported before the result, even if the notice of the worker is late
+        if notices is not None:
+            notices.report(path)
+        return result
+
+    try:
+        with pool(max_workers=jobs, initargs=(budget, threads, None if notices is None else notices.queue)) as executor:
+            pending = collections.deque()
+
+            for path, outputFolder in tasks:
+                if cancel.is_set():
+                    break
+
+                future = executor.submit(convertTask, path, outputFolder, options, cache, profileFolder, None, variants)
+                pending.append((path, future))
+
+                # Waiting in submission order keeps the progress output ordered,
+                # the workers still run ahead on the remaining mapsets
+                while pending and pending[0][1].done():
+                    yield finished(*pending.popleft())
+
+            while pending:
+                if cancel.is_set():
+                    # Mapsets that are already being converted can't be stopped, they're still reported
+                    for path, future in pending:
+                        future.cancel()
+
+                path, future = pending.popleft()
+                if not future.cancelled():
+                    yield finished(path, future)
+    finally:
+        if notices is not None:
+            notices.close()
+
+
+def convertBatch(paths: list, outputFolder: str, options=None, jobs: int = None,
+                 executor: concurrent.futures.Executor = None, iterate: bool = False, recursive: bool = False,
+                 cache: ConversionCache = None, variants: dict = None):
+    """Converts .qp files and folders of .qp files into `outputFolder`, for using qua2osu as a library
+
+    Unlike the command-line tool it doesn't print anything, doesn't open a
+    file explorer and doesn't raise on broken mapsets. Returns a list with a
+    `ConversionResult` (output path, timings, sizes and error) for each
+    mapset in the order they were found. With `iterate` it returns an
+    iterator instead, which yields each result as soon as its mapset is done.
+
+    Missing options fall back to `DEFAULT_OPTIONS`. The mapsets are converted
+    in `executor` if one is given, which isn't shut down afterwards, otherwise
+    in a pool of `jobs` worker processes, or in the current process for a
+    single job. Folders are searched for .qp files, including their
+    subfolders if `recursive` is set.
+
+        results = convertBatch(["songs/"], "output", {"od": 9}, jobs=4)
+        failed = [result.path for result in results if result.error is not None]
+
+    `variants` maps names to options that override `options`, each mapset
+    is then parsed once and written into a subfolder for every variant,
+    see `convertTask()`:
+
+        convertBatch(["songs/"], "output", variants={"od7": {"od": 7}, "od9": {"od": 9, "sampleSet": "Drum"}})
+    """
+
+    options = {**DEFAULT_OPTIONS, **(options or {})}
+    os.makedirs(outputFolder, exist_ok=True)
+
+    if jobs is None:
+        jobs = defaultJobs()
+
+    def conversions():
+        if executor is None and jobs <= 1:
+            for index, path in enumerate(findQpFiles(paths, recursive)):
+                yield index, convertTask(path, outputFolder, options, cache, None, None, variants)
+            return
+
+        pool = executor or concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=setCompressionThreads, initargs=(compressionThreadsBeside(jobs, jobs),)
+        )
+        futures = {}
+
+        try:
+            for index, path in enumerate(findQpFiles(paths, recursive)):
+                futures[pool.submit(convertTask, path, outputFolder, options, cache, None, None, variants)] = index, path
+
+            for future in concurrent.futures.as_completed(futures):
+                index, path = futures[future]
+                yield index, futureResult(path, future)
+        finally:
+            # Mapsets that weren't started yet are dropped if the iterator is closed early
+            for future in futures:
+                future.cancel()
+            if executor is None:
+                pool.shutdown()
+
+    if iterate:
+        return (result for index, result in conversions())
+
+    return [result for index, result in sorted(conversions(), key=lambda item: item[0])]
@@ -0,0 +1,133 @@
+"""Finding .qp files in the input paths"""
+
+# ## Imports
+
+import os  # for paths and directories
+import queue  # to collect the results of concurrent directory scans
+import threading  # to scan multiple input directories at once
+
+# ## Constants
+
+# Amount of input directories that are scanned at the same time
+DEFAULT_SCAN_THREADS = 4
+
+# ## Functions
+
+
+def listDirectory(directory: str, recursive: bool, onError=None) -> tuple:
+    """Returns the .qp files and, if `recursive`, the subdirectories directly inside a directory
+
+    Raises an OSError if the directory can't be read, entries that can't be
+    read are passed to `onError` and skipped.
+    """
+
+    files = []
+    subdirectories = []
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.name.endswith(".qp") and entry.is_file():
+                    files.append(os.path.normpath(entry.path))
+                elif recursive and entry.is_dir():
+                    subdirectories.append(entry.path)
+            except OSError as e:
+                # Broken symlinks and entries that vanished while scanning
+                if onError is not None:
+                    onError(e)
+
+    return files, subdirectories
+
+
+def searchForQpFiles(directory: str, recursive: bool, onError=None, visited: set = None, lock=None):
+    """Yields the paths of all .qp files in a directory as they are found
+
+    Uses `os.scandir()`, which gets the file type of each entry without
+    an extra stat call on most platforms. Directories that were already
+    visited (symlink loops or overlapping inputs) are skipped. Directories
+    that can't be read are passed to `onError` as an OSError and skipped.
+    """
+
+    if visited is None:
+        visited = set()
+    if lock is None:
+        lock = threading.Lock()
+
+    directories = [directory]
+
+    while directories:
+        current = directories.pop()
+
+        try:
+            stat = os.stat(current)
+            with lock:
+                if (stat.st_dev, stat.st_ino) in visited:
+                    continue
+                visited.add((stat.st_dev, stat.st_ino))
+
+            files, subdirectories = listDirectory(current, recursive, onError)
+        except OSError as e:
+            if onError is not None:
+                onError(e)
+            continue
+
+        yield from files
+
+        # Reversed, so that the subdirectories are visited in the order they were listed
+        directories.extend(reversed(subdirectories))
+
+
+def findQpFiles(paths: list, recursive: bool, onError=None, threads: int = DEFAULT_SCAN_THREADS):
+    """Yields all .qp files given directly or found in the given directories
+
+    Multiple input directories are scanned concurrently by up to `threads`
+    threads, the paths are yielded as soon as any of them finds one, so
+    that the conversion can start before the scan is finished
+    """
+
+    directories = []
+
+    for path in paths:
+        if os.path.isfile(path) and path.endswith(".qp"):
+            yield path
+        elif os.path.isdir(path):
+            directories.append(path)
+
+    visited = set()
+    lock = threading.Lock()
+
+    if len(directories) <= 1 or threads <= 1:
+        for directory in directories:
+            yield from searchForQpFiles(directory, recursive, onError, visited, lock)
+        return
+
+    # Each thread scans whole input directories and puts the results into the queue,
+    # None marks a finished thread
+    results = queue.Queue()
+    remaining = queue.Queue()
+    for directory in directories:
+        remaining.put(directory)
+
+    def scan():
+        try:
+            while True:
+                try:
+                    directory = remaining.get_nowait()
+                except queue.Empty:
+                    return
+                for file in searchForQpFiles(directory, recursive, onError, visited, lock):
+                    results.put(file)
+        finally:
+            results.put(None)
+
+    threadCount = min(threads, len(directories))
+    for _ in range(threadCount):
+        threading.Thread(target=scan, daemon=True).start()
+
+    finished = 0
+    while finished < threadCount:
+        file = results.get()
+        if file is None:
+            finished += 1
+        else:
+            yield file
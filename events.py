@@ -0,0 +1,143 @@
+"""Progress events of a batch conversion for the command-line tool, the GUI and --events-jsonl
+
+Each event is a dict with the name of the event in "event" and the unix
+time in "time":
+
+- `run` when the batch starts, with the amount of worker processes in "jobs"
+- `queued` when a mapset is handed to the conversion, with its "path" and "bytes"
+- `start` when a worker actually begins to convert a mapset, with "path" and "bytes"
+- `finish` when a mapset is done, with "path", "bytes", "notes", "elapsed",
+  "cached" and "error" (None on success)
+- `progress` after each finished mapset, see `ProgressEvents.progress()`
+- `end` when the batch is done, with the final progress
+"""
+
+# ## Imports
+
+import json  # to write the events as JSON lines
+import os  # for the sizes of the mapsets
+import threading  # the workers report their starts from other threads
+import time  # for the timestamps and rates
+
+from profiling import ConversionResult
+
+# ## Classes
+
+
+class ProgressEvents:
+    """Keeps track of a batch conversion and sends every event to each listener
+
+    Listeners are called with the event dict. The totals grow while the
+    input directories are still being scanned, so the ETA is only based on
+    the mapsets found so far until `discoveryFinished()` is called. The
+    methods may be called from several threads, the listeners are called
+    by one thread at a time.
+    """
+
+    def __init__(self, jobs: int, listeners: list = None):
+        self.jobs = jobs
+        self.listeners = list(listeners or [])
+        self.startTime = time.time()
+        self.discovering = True
+        self.queued = 0
+        self.finished = 0
+        self.failed = 0
+        self.bytesTotal = 0
+        self.bytesDone = 0
+        self.notesDone = 0
+        # Summed up conversion time of all finished mapsets, for the utilization of the workers
+        self.busy = 0
+        self.sizes = {}
+        self.lock = threading.RLock()
+
+    def emit(self, event: str, **fields) -> dict:
+        with self.lock:
+            event = {"event": event, "time": time.time(), **fields}
+            for listener in self.listeners:
+                listener(event)
+            return event
+
+    def begin(self) -> None:
+        self.startTime = time.time()
+        self.emit("run", jobs=self.jobs)
+
+    def mapsetQueued(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+
+        with self.lock:
+            self.sizes[path] = size
+            self.queued += 1
+            self.bytesTotal += size
+            self.emit("queued", path=path, bytes=size)
+
+    def mapsetStarted(self, path: str) -> None:
+        with self.lock:
+            self.emit("start", path=path, bytes=self.sizes.get(path, 0))
+
+    def mapsetFinished(self, result: ConversionResult) -> None:
+        with self.lock:
+            size = self.sizes.pop(result.path, 0)
+
+            self.finished += 1
+            self.failed += result.error is not None
+            self.bytesDone += size
+            self.notesDone += result.notes
+            self.busy += result.elapsed
+
+            self.emit("finish", path=result.path, bytes=size, notes=result.notes, elapsed=result.elapsed,
+                      cached=result.cached, error=result.error)
+            self.emit("progress", **self.progress())
+
+    def discoveryFinished(self) -> None:
+        self.discovering = False
+
+    def end(self) -> None:
+        with self.lock:
+            self.discovering = False
+            self.emit("end", **self.progress())
+
+    def progress(self) -> dict:
+        """Current totals and rates of the batch
+
+        The ETA is based on the bytes that are left instead of the amount of
+        mapsets, since mapsets differ a lot in size. The utilization is the
+        share of the elapsed time that the `jobs` workers spent converting.
+        """
+
+        elapsed = time.time() - self.startTime
+        bytesPerSecond = self.bytesDone / elapsed if elapsed > 0 else 0
+
+        eta = None
+        if bytesPerSecond > 0:
+            eta = (self.bytesTotal - self.bytesDone) / bytesPerSecond
+
+        return {
+            "finished": self.finished,
+            "failed": self.failed,
+            "total": self.queued,
+            "discovering": self.discovering,
+            "bytesDone": self.bytesDone,
+            "bytesTotal": self.bytesTotal,
+            "elapsed": elapsed,
+            "bytesPerSecond": bytesPerSecond,
+            "notesPerSecond": self.notesDone / elapsed if elapsed > 0 else 0,
+            "eta": eta,
+            "utilization": min(self.busy / (elapsed * self.jobs), 1) if elapsed > 0 else 0
+        }
+
+
+class JsonLinesWriter:
+    """Listener that writes each event as a line of JSON and flushes it right away for live dashboards"""
+
+    def __init__(self, path: str):
+        self.file = open(path, "w", encoding="utf8")
+
+    def __call__(self, event: dict) -> None:
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
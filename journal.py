@@ -0,0 +1,138 @@
+"""Write-ahead journal of finished mapsets, to resume interrupted runs with --resume"""
+
+# ## Imports
+
+import json  # to read and write the journal entries
+import os  # for paths and directories
+import tempfile  # to rewrite the journal atomically
+
+from archive import PARTIAL_SUFFIX
+from cache import outputOptions
+
+# ## Constants
+
+JOURNAL_NAME = ".qua2osu-journal.jsonl"
+JOURNAL_VERSION = 1
+
+# ## Classes
+
+
+class Journal:
+    """Append-only log of the mapsets that were converted in the output folder
+
+    The first line holds the version and the options, every following line
+    one finished mapset with the mtime and size of its .qp and the path of
+    its .osz relative to the output folder. Each entry is flushed to disk
+    as soon as the mapset is finished, so a killed run loses at most the
+    mapsets that were being converted. A torn last line is ignored.
+
+    Without `resume` the journal of the previous run is discarded, with
+    `resume` its entries are kept if the options didn't change.
+    """
+
+    def __init__(self, outputFolder: str, options, resume: bool = False):
+        self.outputFolder = outputFolder
+        self.path = os.path.join(outputFolder, JOURNAL_NAME)
+        # Options that don't change the outputs, e.g. the converter, don't invalidate them
+        self.options = outputOptions(options)
+        self.entries = self.load() if resume else {}
+
+        # Starts from a clean journal with only the kept entries
+        fd, temporaryPath = tempfile.mkstemp(dir=outputFolder, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as file:
+                file.write(json.dumps({"version": JOURNAL_VERSION, "options": self.options}) + "\n")
+                for path, entry in self.entries.items():
+                    file.write(json.dumps({"path": path, **entry}) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporaryPath, self.path)
+        except BaseException:
+            os.remove(temporaryPath)
+            raise
+
+        self.file = open(self.path, "a", encoding="utf8")
+
+    def load(self) -> dict:
+        """Reads the entries of the previous run, empty if its options were different"""
+
+        entries = {}
+
+        try:
+            with open(self.path, "r", encoding="utf8") as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return entries
+
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return entries
+
+        if header.get("version") != JOURNAL_VERSION or header.get("options") != self.options:
+            return entries
+
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Written while the previous run was killed
+                continue
+            entries[entry.pop("path")] = entry
+
+        return entries
+
+    def isFinished(self, path: str, outputPath: str) -> bool:
+        """Checks if a mapset was converted before and is still the same"""
+
+        entry = self.entries.get(os.path.abspath(path))
+
+        if entry is None or entry["output"] != os.path.relpath(outputPath, self.outputFolder):
+            return False
+
+        if not os.path.isfile(outputPath):
+            return False
+
+        stat = os.stat(path)
+
+        return stat.st_mtime == entry["mtime"] and stat.st_size == entry["size"]
+
+    def record(self, path: str, outputPath: str) -> None:
+        """Appends a finished mapset and makes sure it reached the disk"""
+
+        stat = os.stat(path)
+        entry = {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "output": os.path.relpath(outputPath, self.outputFolder)
+        }
+
+        self.entries[os.path.abspath(path)] = entry
+
+        self.file.write(json.dumps({"path": os.path.abspath(path), **entry}) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.file.close()
+
+# ## Functions
+
+
+def removePartialOutputs(outputFolder: str) -> list:
+    """Deletes the .osz files that an interrupted run didn't finish writing
+
+    Returns the list of deleted files
+    """
+
+    removed = []
+
+    for root, dirs, files in os.walk(outputFolder):
+        for name in files:
+            if name.endswith(".osz" + PARTIAL_SUFFIX):
+                path = os.path.join(root, name)
+                os.remove(path)
+                removed.append(path)
+
+    return removed
@@ -0,0 +1,93 @@
+"""Memory budget shared by the worker processes and peak memory measurement for --max-memory"""
+
+# ## Imports
+
+import contextlib  # to reserve memory with a with statement
+import gc  # to free the map objects of a difficulty before releasing its reservation
+import multiprocessing  # to share the budget between the worker processes
+import sys  # to tell the platforms apart
+
+# ## Constants
+
+# Peak memory of converting a .qua file relative to its size, measured on SV heavy maps,
+# reamber's object graphs take up far more than the arrays and text that the direct conversion builds
+REAMBER_MEMORY_FACTOR = 100
+DIRECT_MEMORY_FACTOR = 8
+
+# ## Classes
+
+
+class MemoryBudget:
+    """Limits the estimated memory of the difficulties that are converted at the same time
+
+    Shared by all worker processes, it has to be handed to them when they're
+    started, e.g. through the initializer of the process pool. A reservation
+    larger than the whole budget waits until nothing else is reserved and
+    then runs on its own instead of waiting forever.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.used = multiprocessing.Value("q", 0, lock=False)
+        self.condition = multiprocessing.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, size: int):
+        """Waits until `size` bytes fit into the budget and keeps them reserved inside the with statement"""
+
+        size = min(size, self.size)
+
+        with self.condition:
+            while self.used.value + size > self.size:
+                self.condition.wait()
+            self.used.value += size
+
+        try:
+            yield
+        finally:
+            # Frees everything the conversion left behind before others can use the memory
+            gc.collect()
+            with self.condition:
+                self.used.value -= size
+                self.condition.notify_all()
+
+# ## Functions
+
+
+def resetPeakMemory() -> None:
+    """Resets the peak memory of the current process, only possible on Linux"""
+
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/self/clear_refs", "w") as file:
+                file.write("5")
+        except OSError:
+            pass
+
+
+def peakMemory() -> int:
+    """Returns the peak resident memory of the current process in bytes, or None if unknown
+
+    On Linux this is the peak since the last `resetPeakMemory()`, on other
+    platforms the peak since the process started
+    """
+
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/self/status", "r") as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Kilobytes everywhere except on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
@@ -0,0 +1,189 @@
+"""Pipelined batch conversion that keeps the disk and the CPU busy at the same time"""
+
+# ## Imports
+
+import concurrent.futures  # process pool for the conversion stage
+import io  # to hand the read-ahead mapsets to the zip reader
+import os  # for paths and directories
+import queue  # bounded queues between the stages
+import threading  # reader and writer stages
+import time  # to measure the time of each conversion
+import traceback  # to report errors of single mapsets without aborting the batch
+import zipfile  # to read the .qua files of the read-ahead mapsets
+
+from cache import ConversionCache, hashFile
+from conversion import compressionThreadsBeside, convertQp, defaultJobs, outputPathOf, setCompressionThreads, \
+    submitDifficulties
+from profiling import ConversionResult, StageTimer
+
+# ## Constants
+
+# Threads reading .qp files ahead and submitting their difficulties to the process pool
+DEFAULT_READERS = 2
+
+# Threads assembling .osz files from the converted difficulties
+DEFAULT_WRITERS = 2
+
+# Mapsets that may wait in memory between the reader and the writer stage
+DEFAULT_QUEUE_SIZE = 4
+
+# ## Functions
+
+
+def convertPipelined(tasks, options, jobs: int = None, readers: int = DEFAULT_READERS,
+                     writers: int = DEFAULT_WRITERS, queueSize: int = DEFAULT_QUEUE_SIZE,
+                     cache: ConversionCache = None, profileFolder: str = None, onStart=None):
+    """Converts multiple mapsets in three overlapping stages
+
+    Reader threads load whole .qp files into memory and right away submit
+    their .qua files to a pool of `jobs` worker processes, writer threads
+    assemble the .osz files from the converted difficulties and the
+    remaining members of the read-ahead .qp. The difficulties of every
+    read-ahead mapset are in the pool at the same time, so the pool stays
+    busy no matter how few difficulties each mapset has. The stages are
+    connected by a queue of `queueSize` mapsets, so a slow stage holds up
+    the ones in front of it instead of letting the read-ahead mapsets pile
+    up in memory. At most `queueSize + readers + writers` mapsets are in
+    memory at once.
+
+    `tasks` is an iterable of `(path, outputFolder)` tuples like for
+    `convertMapsets()`. The conversions of the difficulties are profiled
+    into `profileFolder` if one is given. `onStart` is called with the path
+    of each mapset by the reader thread that starts on it. Yields a
+    `ConversionResult` for each task in the order the mapsets are finished.
+    """
+
+    if jobs is None:
+        jobs = defaultJobs()
+
+    tasks = iter(tasks)
+    taskLock = threading.Lock()
+
+    # Items are (result, timer, outputFolder, key, data, futures), None tells a writer to stop
+    readQueue = queue.Queue(maxsize=queueSize)
+    # Items are results, None tells that a writer stopped
+    results = queue.Queue()
+
+    # Errors of the task iterable itself, raised again in the calling thread
+    taskErrors = []
+    runningReaders = readers
+    stopping = threading.Event()
+
+    def nextTask():
+        with taskLock:
+            if taskErrors:
+                return None
+            try:
+                return next(tasks, None)
+            except BaseException as e:
+                taskErrors.append(e)
+                return None
+
+    def read(executor):
+        nonlocal runningReaders
+
+        try:
+            while not stopping.is_set():
+                task = nextTask()
+                if task is None:
+                    return
+
+                path, outputFolder = task
+                if onStart is not None:
+                    onStart(path)
+
+                timer = StageTimer()
+                result = ConversionResult(path, outputPathOf(path, outputFolder))
+                start = time.perf_counter()
+                key = None
+                data = None
+                futures = None
+
+                try:
+                    if cache is not None:
+                        with timer.stage("cache"):
+                            result.sourceHash = hashFile(path)
+                            key = cache.key(path, options, result.sourceHash)
+                            result.cached = cache.fetch(key, result.outputPath)
+
+                    if not result.cached:
+                        with timer.stage("read", os.path.getsize(path)):
+                            with open(path, "rb") as file:
+                                data = file.read()
+
+                        # The writers only wait for the results
+                        with zipfile.ZipFile(io.BytesIO(data), "r") as oldDir:
+                            futures = submitDifficulties(oldDir, [options], executor, timer, profileFolder)
+                except Exception:
+                    result.error = traceback.format_exc()
+                    result.outputPath = None
+
+                result.elapsed = time.perf_counter() - start
+                readQueue.put((result, timer, outputFolder, key, data, futures))
+        finally:
+            with taskLock:
+                runningReaders -= 1
+                last = runningReaders == 0
+            # The last reader tells every writer that there's nothing left
+            if last:
+                for _ in range(writers):
+                    readQueue.put(None)
+
+    def write():
+        try:
+            while True:
+                item = readQueue.get()
+                if item is None:
+                    return
+
+                result, timer, outputFolder, key, data, futures = item
+                start = time.perf_counter()
+
+                if result.error is None and not result.cached:
+                    try:
+                        convertQp(result.path, outputFolder, options, timer, None, io.BytesIO(data), futures)
+                        if cache is not None:
+                            with timer.stage("cache"):
+                                cache.store(key, result.outputPath)
+                    except Exception:
+                        result.error = traceback.format_exc()
+                        result.outputPath = None
+                        for future in (futures or {}).values():
+                            future.cancel()
+
+                # Only counts the time spent in the stages, not the time spent waiting in the queue
+                result.elapsed += time.perf_counter() - start
+                result.stages = timer.seconds
+                result.sizes = timer.sizes
+                result.notes = timer.notes
+                result.assets = timer.assets
+                results.put(result)
+        finally:
+            results.put(None)
+
+    # The writers compress in this process, while the worker processes convert
+    setCompressionThreads(compressionThreadsBeside(jobs))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        threads = [threading.Thread(target=read, args=(executor,), daemon=True) for _ in range(readers)]
+        threads += [threading.Thread(target=write, daemon=True) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            runningWriters = writers
+            while runningWriters:
+                result = results.get()
+                if result is None:
+                    runningWriters -= 1
+                else:
+                    yield result
+        finally:
+            # Lets the readers run out if the caller stops early, the writers
+            # still finish the mapsets that were already read
+            stopping.set()
+            for thread in threads:
+                thread.join()
+
+    if taskErrors:
+        raise taskErrors[0]
@@ -0,0 +1,209 @@
+"""Per-stage timing of conversions and the --profile report"""
+
+# ## Imports
+
+import contextlib  # to time stages with a with statement
+import json  # to write the profile data
+import os  # for paths and directories
+import time  # to measure execution time
+
+# ## Constants
+
+# Order of the stages in the report, unknown stages are appended at the end
+STAGES = ["cache", "read", "parse", "convert", "overrides", "write", "archive"]
+
+# ## Classes
+
+
+class StageTimer:
+    """Sums up the time spent and bytes processed in each stage of a conversion"""
+
+    def __init__(self):
+        self.seconds = {}
+        self.sizes = {}
+        # Peak resident memory in bytes of the process that ran the stages, if known
+        self.peakMemory = None
+        # Notes of the converted difficulties
+        self.notes = 0
+        # SHA-256 hex digest and size of each copied asset, only with the dedupe option
+        self.assets = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str, size: int = 0):
+        """Times the code inside the with statement and counts `size` bytes for it"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - start
+            self.sizes[name] = self.sizes.get(name, 0) + size
+
+    def count(self, name: str, size: int) -> None:
+        """Counts bytes for a stage that is timed elsewhere"""
+
+        self.sizes[name] = self.sizes.get(name, 0) + size
+
+    def merge(self, other) -> None:
+        """Adds the times and bytes of another timer, e.g. one of a worker process"""
+
+        for name, seconds in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0) + seconds
+        for name, size in other.sizes.items():
+            self.sizes[name] = self.sizes.get(name, 0) + size
+        self.notes += other.notes
+        self.assets.extend(other.assets)
+        if other.peakMemory is not None:
+            self.peakMemory = max(self.peakMemory or 0, other.peakMemory)
+
+
+class ConversionResult:
+    """Outcome of converting a single mapset
+
+    `error` is None on success, otherwise the formatted traceback. `stages`
+    and `sizes` map the stage names to seconds and bytes. `peakMemory` is the
+    peak resident memory in bytes of the conversion, None if unknown. `notes`
+    is the amount of notes in all converted difficulties. `outputPaths` lists
+    the .osz file of each variant if the mapset was converted with variants,
+    `outputPath` is the first of them then. `assets` lists the digest and
+    size of each copied asset with the dedupe option, see `formatDedupeReport()`. `sourceHash` is the SHA-256 hex
+    digest of the .qp file if it was hashed for the cache, None otherwise.
+    """
+
+    def __init__(self, path: str, outputPath: str = None, error: str = None, elapsed: float = 0,
+                 stages: dict = None, sizes: dict = None, cached: bool = False, peakMemory: int = None,
+                 notes: int = 0, outputPaths: list = None, sourceHash: str = None, assets: list = None):
+        self.path = path
+        self.outputPath = outputPath
+        self.error = error
+        self.elapsed = elapsed
+        self.stages = stages or {}
+        self.sizes = sizes or {}
+        self.cached = cached
+        self.peakMemory = peakMemory
+        self.notes = notes
+        self.outputPaths = outputPaths
+        self.sourceHash = sourceHash
+        self.assets = assets or []
+
+    def asDict(self) -> dict:
+        return dict(vars(self))
+
+# ## Functions
+
+
+def orderedStages(names) -> list:
+    return [stage for stage in STAGES if stage in names] + sorted(set(names) - set(STAGES))
+
+
+def formatProfile(results: list, top: int = 10) -> str:
+    """Creates the per-stage breakdown and the list of the slowest mapsets"""
+
+    seconds = {}
+    sizes = {}
+
+    for result in results:
+        for stage, elapsed in result.stages.items():
+            seconds[stage] = seconds.get(stage, 0) + elapsed
+        for stage, size in result.sizes.items():
+            sizes[stage] = sizes.get(stage, 0) + size
+
+    total = sum(seconds.values()) or 1
+    lines = ["Stage           time      share        MiB      MiB/s"]
+
+    for stage in orderedStages(seconds):
+        mebibytes = sizes.get(stage, 0) / 1024 / 1024
+        throughput = mebibytes / seconds[stage] if seconds[stage] else 0
+        lines.append(f"{stage:<10} {seconds[stage]:8.2f} s {seconds[stage] / total:9.1%} "
+                     f"{mebibytes:10.1f} {throughput:10.1f}")
+
+    lines.append("")
+    lines.append(f"Slowest {min(top, len(results))} mapsets:")
+
+    for result in sorted(results, key=lambda result: result.elapsed, reverse=True)[:top]:
+        lines.append(f"{result.elapsed:8.2f} s  {result.path}")
+
+    measured = [result for result in results if result.peakMemory is not None]
+
+    if measured:
+        lines.append("")
+        lines.append(f"Highest peak memory of {min(top, len(measured))} mapsets:")
+
+        for result in sorted(measured, key=lambda result: result.peakMemory, reverse=True)[:top]:
+            lines.append(f"{result.peakMemory / 1024 / 1024:8.1f} MiB  {result.path}")
+
+    return "\n".join(lines)
+
+
+def formatDedupeReport(results: list) -> str:
+    """Sums up how many bytes of the copied assets were the same as assets of other mapsets in the batch
+
+    Only a report, every asset is still read and copied into the .osz of its
+    own mapset. The assets of all worker processes are compared here, so
+    the numbers don't depend on how many there were.
+    """
+
+    seen = set()
+    total = 0
+    duplicates = 0
+
+    for result in results:
+        for digest, size in result.assets:
+            total += size
+            if (digest, size) in seen:
+                duplicates += size
+            seen.add((digest, size))
+
+    return (f"Copied {total / 1024 / 1024:.1f} MiB of assets, {duplicates / 1024 / 1024:.1f} MiB "
+            f"({duplicates / (total or 1):.1%}) were copies of assets in other mapsets and could be shared")
+
+
+def formatArchiveReport(results: list) -> str:
+    """Sums up the size and throughput of building the .osz archives and how much the .osu files were compressed"""
+
+    size = sum(result.sizes.get("archive", 0) for result in results)
+    seconds = sum(result.stages.get("archive", 0) for result in results)
+    osu = sum(result.sizes.get("osu", 0) for result in results)
+    compressed = sum(result.sizes.get("osuCompressed", 0) for result in results)
+
+    throughput = size / 1024 / 1024 / seconds if seconds else 0
+
+    return (f"Built {size / 1024 / 1024:.1f} MiB of .osz archives at {throughput:.1f} MiB/s per worker process, "
+            f"the .osu files were written at {compressed / (osu or 1):.1%} of their {osu / 1024 / 1024:.1f} MiB")
+
+
+def writeProfile(results: list, path: str, profileFolder: str = None) -> None:
+    """Writes the profile data of a run
+
+    Merges the cProfile dumps of the worker processes in `profileFolder`
+    if the path ends with .prof, otherwise writes the stage timings of each
+    mapset as JSON
+    """
+
+    if path.endswith(".prof"):
+        # Only imported when needed, pstats alone adds noticeably to the startup time
+        import pstats
+
+        dumps = [os.path.join(profileFolder, name) for name in os.listdir(profileFolder)]
+        if not dumps:
+            return
+        stats = pstats.Stats(*dumps)
+        stats.dump_stats(path)
+        return
+
+    with open(path, "w", encoding="utf8") as file:
+        json.dump([result.asDict() for result in results], file, indent=1)
+
+
+def profiled(profileFolder: str, function, *args):
+    """Runs a function under cProfile and dumps the profile into `profileFolder`"""
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        # Unique per call, since several workers write into the same folder
+        profiler.dump_stats(os.path.join(profileFolder, f"{os.getpid()}-{time.perf_counter_ns()}.prof"))
@@ -1,5 +1,7 @@
+import multiprocessing
 import os
 import sys
+import threading  # to cancel the conversion from the UI thread
 import time
 import webbrowser  # to open the explorer cross-platform
 
@@ -7,13 +9,18 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
-from conversion import convertMapset
+from conversion import convertMapsets, defaultJobs
+from discovery import searchForQpFiles
+from events import ProgressEvents
 
 # gui.py is autogenerated from gui.ui (qt designer)
 
 # use "pyuic5 -x gui/gui.ui -o gui/gui.py" after editing gui.ui with qt designer
 from gui.gui import Ui_MainWindow
 
+# Minimum seconds between two status updates, large batches would flood the UI thread with signals otherwise
+STATUS_INTERVAL = 0.1
+
 
 class IceMainWindow(QMainWindow, Ui_MainWindow):
     """Custom window class with all of the GUI functionality
@@ -27,6 +34,7 @@ class IceMainWindow(QMainWindow, Ui_MainWindow):
         self.inputToolButton.clicked.connect(self.openInputDirectoryDialog)
         self.outputToolButton.clicked.connect(self.openOutputDirectoryDialog)
         self.convertPushButton.clicked.connect(self.convertOnClick)
+        self.converterThread = None
 
         self.updateStatus("Finished setup")
 
@@ -58,10 +66,10 @@ class IceMainWindow(QMainWindow, Ui_MainWindow):
 
         self.progressBar.setMaximum(maximum)
 
-    def incrementProgressBarValue(self):
-        """Increments the progress bar by one unit total, adds a smooth animation"""
+    def updateProgressBarValue(self, value):
+        """Wrapper for updating the progress bar value"""
 
-        self.progressBar.setValue(self.progressBar.value() + 1)
+        self.progressBar.setValue(value)
 
     def initiateConverterThread(self, inputPath, outputPath, options):
         """Sets up the converter thread"""
@@ -70,13 +78,20 @@ class IceMainWindow(QMainWindow, Ui_MainWindow):
         converterThread.updateStatus.connect(self.updateStatus)
         converterThread.updateProgressbarMax.connect(
             self.updateProgressBarMax)
-        converterThread.incrementProgressbarValue.connect(
-            self.incrementProgressBarValue)
+        converterThread.updateProgressbarValue.connect(
+            self.updateProgressBarValue)
 
         return converterThread
 
     def convertOnClick(self):
-        """Starts the map conversion of the folder"""
+        """Starts the map conversion of the folder, or cancels it while it's running"""
+
+        if self.converterThread is not None and self.converterThread.isRunning():
+            self.converterThread.cancel()
+            self.convertPushButton.setEnabled(False)
+            self.convertPushButton.setText("Cancelling...")
+            self.updateStatus("Cancelling, waiting for the mapsets that are already being converted")
+            return
 
         inputPath = self.inputLineEdit.text()
         outputPath = self.outputLineEdit.text()
@@ -119,8 +134,26 @@ class IceMainWindow(QMainWindow, Ui_MainWindow):
 
         self.converterThread = self.initiateConverterThread(
             inputPath, outputPath, options)
+        self.converterThread.finished.connect(self.onConversionFinished)
         self.converterThread.start()
 
+        self.convertPushButton.setText("Cancel")
+
+    def onConversionFinished(self):
+        """Turns the cancel button back into the convert button"""
+
+        self.convertPushButton.setEnabled(True)
+        self.convertPushButton.setText("Convert")
+
+    def closeEvent(self, event):
+        """Stops a running conversion before the window closes"""
+
+        if self.converterThread is not None and self.converterThread.isRunning():
+            self.converterThread.cancel()
+            self.converterThread.wait()
+
+        event.accept()
+
 
 class ConverterThread(QThread):
     """Using a different thread for the map conversion
@@ -129,25 +162,25 @@ class ConverterThread(QThread):
     """
 
     updateStatus = pyqtSignal(str)
-    incrementProgressbarValue = pyqtSignal()
     updateProgressbarMax = pyqtSignal(int)
+    updateProgressbarValue = pyqtSignal(int)
 
     def __init__(self, inputPath, outputPath, options):
         QThread.__init__(self)
         self.inputPath = inputPath
         self.outputPath = outputPath
         self.options = options
+        self.cancelled = threading.Event()
+        self.lastStatus = 0
+        self.lastConverted = None
 
-    def __del__(self):
-        self.wait()
+    def cancel(self):
+        """Stops the conversion, see `convertMapsets()` for what is still finished"""
 
-    def run(self):
-        qpFilesInInputDir = []
+        self.cancelled.set()
 
-        for file in os.listdir(self.inputPath):
-            path = os.path.join(self.inputPath, file)
-            if file.endswith('.qp') and os.path.isfile(path):
-                qpFilesInInputDir.append(file)
+    def run(self):
+        qpFilesInInputDir = list(searchForQpFiles(self.inputPath, False))
 
         numberOfQpFiles = len(qpFilesInInputDir)
 
@@ -155,24 +188,34 @@ class ConverterThread(QThread):
             self.updateStatus.emit("No mapsets found in " + self.inputPath)
             return
 
-        self.updateProgressbarMax.emit(numberOfQpFiles)
-
         start = time.time()
-        count = 1
 
-        for file in qpFilesInInputDir:
-            filePath = os.path.join(self.inputPath, file)
+        tasks = [(filePath, self.outputPath) for filePath in qpFilesInInputDir]
+
+        events = ProgressEvents(defaultJobs(), [self.onEvent])
+        events.begin()
+
+        # All mapsets are known up front, so the progress bar can
+        # follow the converted bytes instead of the converted mapsets
+        for filePath in qpFilesInInputDir:
+            events.mapsetQueued(filePath)
+        events.discoveryFinished()
 
-            self.updateStatus.emit(f"({count}/{numberOfQpFiles}) "
-                                   f"Converting {filePath}")
+        # The progress bar only takes ints, so it counts KiB
+        self.updateProgressbarMax.emit(max(events.bytesTotal // 1024, 1))
 
-            convertMapset(filePath, self.outputPath, self.options)
-            count += 1
-            self.incrementProgressbarValue.emit()
+        for result in convertMapsets(tasks, self.options, cancel=self.cancelled, onStart=events.mapsetStarted):
+            events.mapsetFinished(result)
+
+        events.end()
 
         end = time.time()
         timeElapsed = round(end - start, 2)
 
+        if self.cancelled.is_set():
+            self.updateStatus.emit(f"Cancelled after converting {events.finished} of {numberOfQpFiles} mapsets")
+            return
+
         self.updateStatus.emit(
             f"Finished converting all mapsets,"
             f"total time elapsed: {timeElapsed} seconds"
@@ -184,6 +227,38 @@ class ConverterThread(QThread):
 
         return
 
+    def onEvent(self, event):
+        """Shows the progress events of the conversion in the status label and the progress bar
+
+        Updates at most every `STATUS_INTERVAL` seconds, failed mapsets and
+        the end of the conversion are always shown right away
+        """
+
+        if event["event"] == "finish":
+            if event["error"] is None:
+                # Shown with the next progress update
+                self.lastConverted = event["path"]
+            else:
+                self.updateStatus.emit(f"Failed to convert {event['path']}")
+            return
+
+        if event["event"] not in ["progress", "end"]:
+            return
+
+        if event["event"] == "progress" and event["time"] - self.lastStatus < STATUS_INTERVAL:
+            return
+        self.lastStatus = event["time"]
+
+        if self.lastConverted is not None:
+            self.updateStatus.emit(f"Converted {self.lastConverted}")
+            self.lastConverted = None
+
+        self.updateProgressbarValue.emit(event["bytesDone"] // 1024)
+
+        eta = "" if event["eta"] is None else f", {round(event['eta'])} s left"
+        self.updateStatus.emit(f"({event['finished']}/{event['total']}) "
+                               f"{event['notesPerSecond']:.0f} notes/s{eta}")
+
 
 class IceApp(QApplication):
     """Custom QApplication class for the sole purpose of applying the Fusion style"""
@@ -201,4 +276,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # Required for the worker processes in frozen executables on Windows
+    multiprocessing.freeze_support()
     main()
@@ -3,23 +3,25 @@
 # ## Imports
 
 import argparse  # parsing command line arguments
+import json  # to read the --variants file
+import multiprocessing  # freeze support for the worker processes
 import os  # for paths and directories
-import re
+import shutil  # to remove the temporary profile folder
 import sys  # used only for sys.exit()
+import tempfile  # to collect the profiles of the worker processes
 import time  # to measure execution time
 import webbrowser  # to open the explorer cross-platform
-import zipfile  # to handle .zip files (.qua and .osz)
 
-from reamber.algorithms.convert import QuaToOsu
-from reamber.quaver import QuaMap
-
-# ## Constants
-
-SAMPLESETS = [
-    "Soft",
-    "Normal",
-    "Drum"
-]
+from archive import STORE_LEVEL
+from cache import DEFAULT_CACHE_SIZE, ConversionCache, defaultCacheDir
+from conversion import DEFAULT_OPTIONS, SAMPLESETS, convertMapsets, defaultJobs, outputPathOf
+from discovery import findQpFiles
+from events import JsonLinesWriter, ProgressEvents
+from journal import Journal, removePartialOutputs
+from pipeline import DEFAULT_QUEUE_SIZE, DEFAULT_READERS, DEFAULT_WRITERS, convertPipelined
+from profiling import formatArchiveReport, formatDedupeReport, formatProfile, writeProfile
+from sync import SyncManifest
+from watch import FolderWatcher, isSettled, watch
 
 # ## Functions
 
@@ -30,7 +32,7 @@ def initArgParser() -> argparse.ArgumentParser:
     argParser = argparse.ArgumentParser("Converts .qp files to .osz files")
 
     def qpOrDirPath(inputPath):
-        if (inputPath.endswith(".qp") and os.path.isFile(inputPath)) or os.path.isdir(inputPath):
+        if (inputPath.endswith(".qp") and os.path.isfile(inputPath)) or os.path.isdir(inputPath):
             return inputPath
         else:
             raise argparse.ArgumentTypeError("Path is not a directory or not a .qp file")
@@ -131,85 +133,248 @@ def initArgParser() -> argparse.ArgumentParser:
         action="store_true"
     )
 
-    return argParser
+    def jobCount(n):
+        n = int(n)
+        if n >= 1:
+            return n
+        else:
+            raise argparse.ArgumentTypeError("Value must be at least 1")
 
+    argParser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        help="Amount of mapsets converted in parallel, defaults to the CPU count",
+        default=defaultJobs(),
+        type=jobCount
+    )
 
-def searchForQpFiles(directory: str, qpList: list, recursive: bool) -> list:
-    for path in os.listdir(directory):
-        fullRelativePath = os.path.join(directory, path)
-        if os.path.isfile(fullRelativePath) and fullRelativePath.endswith(".qp"):
-            qpList.append(os.path.normpath(fullRelativePath))
-        elif os.path.isdir(fullRelativePath) and recursive:
-            searchForQpFiles(fullRelativePath, qpList, recursive)
+    argParser.add_argument(
+        "--pipeline",
+        required=False,
+        help="Reads, converts and writes mapsets in separate overlapping stages instead of one mapset per process",
+        action="store_true"
+    )
 
+    argParser.add_argument(
+        "--readers",
+        required=False,
+        help=f"Threads reading mapsets ahead with --pipeline, defaults to {DEFAULT_READERS}",
+        default=DEFAULT_READERS,
+        type=jobCount
+    )
 
-def convertQp(path: str, outputFolder: str, options) -> None:
-    """Converts a whole .qp mapset to a .osz mapset
+    argParser.add_argument(
+        "--writers",
+        required=False,
+        help=f"Threads writing .osz files with --pipeline, defaults to {DEFAULT_WRITERS}",
+        default=DEFAULT_WRITERS,
+        type=jobCount
+    )
 
-    Moves all files to a new directory and converts all .qua files to .osu files
+    argParser.add_argument(
+        "--queue-size",
+        required=False,
+        help=f"Mapsets waiting in memory between the stages with --pipeline, defaults to {DEFAULT_QUEUE_SIZE}",
+        default=DEFAULT_QUEUE_SIZE,
+        type=jobCount
+    )
 
-    Options parameter is built up as following:
+    def memorySize(n):
+        n = int(n)
+        if n >= 1:
+            return n * 1024 * 1024
+        else:
+            raise argparse.ArgumentTypeError("Value must be at least 1")
 
-        options = {
-            "od": int,
-            "hp": int,
-            "hitSoundVolume": int,
-            "sampleSet": ["Soft","Normal","Drum"]
-        }
-    """
+    argParser.add_argument(
+        "--max-memory",
+        required=False,
+        help="Limits the estimated memory in MiB of the difficulties that are converted at the same time "
+             "and prints the peak memory of each mapset",
+        type=memorySize,
+        metavar="MIB"
+    )
+
+    argParser.add_argument(
+        "--no-cache",
+        required=False,
+        help="Converts all mapsets again instead of reusing unchanged ones from the cache",
+        action="store_true"
+    )
+
+    argParser.add_argument(
+        "--cache-dir",
+        required=False,
+        help=f"Path of the conversion cache, defaults to {defaultCacheDir()}",
+        default=defaultCacheDir(),
+        type=str
+    )
+
+    def cacheSize(n):
+        n = int(n)
+        if n >= 0:
+            return n * 1024 * 1024
+        else:
+            raise argparse.ArgumentTypeError("Value must be at least 0")
+
+    argParser.add_argument(
+        "--cache-size",
+        required=False,
+        help=f"Maximum size of the conversion cache in MiB, defaults to {DEFAULT_CACHE_SIZE // 1024 // 1024}",
+        default=DEFAULT_CACHE_SIZE,
+        type=cacheSize
+    )
+
+    argParser.add_argument(
+        "-f",
+        "--fast",
+        required=False,
+        help="Converts .qua files straight to .osu text without building reamber map objects, same output but faster",
+        action="store_true"
+    )
+
+    def variantsFile(path):
+        try:
+            with open(path, "r", encoding="utf8") as file:
+                variants = json.load(file)
+        except (OSError, ValueError) as e:
+            raise argparse.ArgumentTypeError(f"Can't read the variants: {e}")
+
+        if not isinstance(variants, dict) or not variants:
+            raise argparse.ArgumentTypeError("Expected a JSON object that maps variant names to options")
+
+        for name, overrides in variants.items():
+            if not name or os.path.basename(name) != name or name in (".", ".."):
+                raise argparse.ArgumentTypeError(f"Variant name {name!r} is not a valid folder name")
+            if not isinstance(overrides, dict):
+                raise argparse.ArgumentTypeError(f"The options of variant {name} are not a JSON object")
+            unknown = set(overrides) - (set(DEFAULT_OPTIONS) - {"fast", "mmap", "compressionLevel", "dedupe"})
+            if unknown:
+                raise argparse.ArgumentTypeError(f"Unknown options in variant {name}: {', '.join(sorted(unknown))}")
+            if overrides.get("sampleSet", "Soft") not in SAMPLESETS:
+                raise argparse.ArgumentTypeError(f"sampleSet of variant {name} must be one of {', '.join(SAMPLESETS)}")
+
+            if overrides.get("creator") is not None and not isinstance(overrides["creator"], str):
+                raise argparse.ArgumentTypeError(f"creator of variant {name} must be a string")
+
+            # Same checks and types as the matching command line arguments
+            for key, check in [("od", diffValue), ("hp", diffValue), ("hitSoundVolume", hsVolume)]:
+                if key in overrides:
+                    # JSON booleans are ints in Python, the service rejects them as well
+                    if isinstance(overrides[key], bool):
+                        raise argparse.ArgumentTypeError(f"Invalid {key} in variant {name}: expected a number")
+                    try:
+                        overrides[key] = check(overrides[key])
+                    except (ValueError, TypeError, argparse.ArgumentTypeError) as e:
+                        raise argparse.ArgumentTypeError(f"Invalid {key} in variant {name}: {e}")
+
+        return variants
+
+    argParser.add_argument(
+        "--variants",
+        required=False,
+        help="JSON file that maps variant names to options, "
+             "e.g. {\"od7\": {\"od\": 7}, \"drum\": {\"sampleSet\": \"Drum\"}}. Each mapset is parsed once "
+             "and written into the subfolder of every variant, with the other options as the defaults",
+        type=variantsFile,
+        metavar="PATH"
+    )
+
+    argParser.add_argument(
+        "--mmap",
+        required=False,
+        help="Reads the .qp files through a memory map instead of many small reads, "
+             "falls back to regular reads for files that can't be mapped",
+        action="store_true"
+    )
+
+    def compressionLevel(n):
+        n = int(n)
+        if n >= 1 and n <= 9:
+            return n
+        else:
+            raise argparse.ArgumentTypeError("Value must be between 1 and 9")
+
+    compression = argParser.add_mutually_exclusive_group()
+
+    compression.add_argument(
+        "--compression-level",
+        required=False,
+        help="Deflates the .osu files at a level between 1 (fastest) and 9 (smallest) in parallel threads "
+             "and prints the archive build throughput, they're stored uncompressed by default",
+        type=compressionLevel,
+        metavar="LEVEL"
+    )
+
+    compression.add_argument(
+        "--store",
+        required=False,
+        help="Stores every file uncompressed, also audio and images that are compressed in the .qp, "
+             "which makes bigger .osz files that osu! imports faster, and prints the archive build throughput",
+        action="store_true"
+    )
+
+    argParser.add_argument(
+        "-s",
+        "--sync",
+        required=False,
+        help="Only converts new or changed mapsets and deletes outputs of mapsets that aren't part of the input anymore",
+        action="store_true"
+    )
+
+    argParser.add_argument(
+        "--dedupe-report",
+        required=False,
+        help="Hashes the assets with SHA-256 while copying them and prints how many bytes are the same as in other "
+             "mapsets of the batch, every asset is still copied into its own .osz",
+        action="store_true"
+    )
+
+    argParser.add_argument(
+        "-w",
+        "--watch",
+        required=False,
+        help="Keeps running after converting the input and converts new or changed .qp files "
+             "as soon as they're completely written, until stopped with Ctrl+C",
+        action="store_true"
+    )
+
+    argParser.add_argument(
+        "--resume",
+        required=False,
+        help="Skips the mapsets that an interrupted run already converted and removes its unfinished .osz files",
+        action="store_true"
+    )
+
+    argParser.add_argument(
+        "--events-jsonl",
+        required=False,
+        help="Writes progress events (queue, start and finish of each mapset, throughput, ETA, worker utilization) "
+             "as JSON lines to a file while converting",
+        type=str,
+        metavar="PATH"
+    )
+
+    argParser.add_argument(
+        "--profile",
+        required=False,
+        help="Prints the time spent in each conversion stage and the N slowest mapsets, N defaults to 10",
+        nargs="?",
+        const=10,
+        type=int,
+        metavar="N"
+    )
+
+    argParser.add_argument(
+        "--profile-out",
+        required=False,
+        help="Writes the stage timings of each mapset as JSON, or cProfile data if the path ends with .prof",
+        type=str
+    )
+
+    return argParser
 
-    # Prefixing with "q_" to prevent osu from showing the wrong preview
-    # backgrounds, because it takes the folder number to
-    # choose the background for whatever reason
-    folderName = "q_" + os.path.basename(path).replace(".qp", "")
-    outputPath = os.path.join(outputFolder, folderName)
-
-    # Opens the .qp (.zip) mapset file and extracts it into a folder in the same directory
-    with zipfile.ZipFile(path, "r") as oldDir:
-        oldDir.extractall(outputPath)
-
-    # Converts each .qua difficulty file
-    for file in os.listdir(outputPath):
-        filePath = os.path.join(outputPath, file)
-
-        # Replaces each .qua file with the converted .osu file, uses Evening's reamber package
-        if file.endswith(".qua"):
-            qua = QuaMap.readFile(filePath)
-            convertedOsu = QuaToOsu.convert(qua)
-
-            if options["od"]:
-                convertedOsu.overallDifficulty = options["od"]
-            if options["hp"]:
-                convertedOsu.hpDrainRate = options["hp"]
-            if options["creator"]:
-                convertedOsu.creator = options["creator"]
-
-            if options["hitSoundVolume"] or options["sampleset"]:
-                for list in [convertedOsu.bpms.data(), convertedOsu.svs.data()]:
-                    for element in list:
-                        if options["hitSoundVolume"]:
-                            element.volume = options["hitSoundVolume"]
-                        if options["sampleSet"]:
-                            element.sampleSet = SAMPLESETS.index(options["sampleSet"])
-
-            newFileName = re.sub(r"\.qua$", ".osu", filePath, 1, re.MULTILINE)
-            convertedOsu.writeFile(newFileName)
-            os.remove(filePath)
-
-    # Creates a new .osz (.zip) mapset file
-    with zipfile.ZipFile(outputPath + ".osz", "w") as newDir:
-        for root, dirs, files in os.walk(outputPath):
-            for file in files:
-                newDir.write(os.path.join(root, file), file)
-
-    # Delete all files in output dir
-    for root, dirs, files in os.walk(outputPath, topdown=False):
-        for name in files:
-            os.remove(os.path.join(root, name))
-        for name in dirs:
-            os.rmdir(os.path.join(root, name))
-
-    os.rmdir(outputPath)
 
 # ### Main
 
@@ -230,22 +395,13 @@ def main():
 
     print(args)
 
-    # Filters for all files that end with .qp and puts the
-    # complete path of the files into an array
-
-    qpFilesInInputDir = []
+    if args["pipeline"] and args["max_memory"] is not None:
+        argParser.error("--max-memory can't be combined with --pipeline, which reads whole mapsets ahead")
 
-    for path in args["input"]:
-        if os.path.isfile(path) and path.endswith(".qp"):
-            qpFilesInInputDir.append(path)
-        elif os.path.isdir(path):
-            searchForQpFiles(path, qpFilesInInputDir, args["recursive_search"])
-
-    print(qpFilesInInputDir)
-
-    if len(qpFilesInInputDir) == 0:
-        print("No mapsets found in given paths")
-        sys.exit(1)
+    if args["variants"] is not None:
+        for flag in ["pipeline", "sync", "resume", "watch"]:
+            if args[flag]:
+                argParser.error(f"--variants can't be combined with --{flag}")
 
     # Assigns the arguments to an options object to pass to
     # the `convertQp()` function
@@ -254,22 +410,178 @@ def main():
         "hp": args["hp_drain"],
         "hitSoundVolume": args["hitsound_volume"],
         "sampleSet": args["sampleset"],
-        "creator": args["creator"]
+        "creator": args["creator"],
+        "fast": args["fast"],
+        "mmap": args["mmap"],
+        "compressionLevel": STORE_LEVEL if args["store"] else args["compression_level"],
+        "dedupe": args["dedupe_report"]
     }
 
     # Starts the timer for the total execution time
     start = time.time()
 
-    # Run the conversion for each .qp file
-    for file in qpFilesInInputDir:
+    # Unchanged mapsets are copied out of the cache instead of converted again
+    cache = None if args["no_cache"] else ConversionCache(args["cache_dir"], args["cache_size"])
+
+    # Only converts the mapsets that changed since the last synced run
+    manifest = SyncManifest(args["output"], options) if args["sync"] else None
+
+    # Every finished mapset is journaled right away, so an interrupted run can be resumed
+    if args["resume"]:
+        for path in removePartialOutputs(args["output"]):
+            print(f"Removed unfinished {path}")
+    journal = Journal(args["output"], options, args["resume"])
+
+    scanErrors = []
+
+    def printScanError(error):
+        scanErrors.append(error)
+        print(f"Skipping {error.filename}: {error.strerror}", file=sys.stderr)
+
+    # The .qp files are converted while the input directories are still being scanned
+    qpFilesInInputDir = []
+    skipped = 0
+    resumed = 0
+    # Maps each .osz to the mapset it's converted from, so no two mapsets write the same file
+    outputSources = {}
+    clashes = 0
+
+    def outputFolderOf(file):
         basePath = os.path.dirname(file) if args["preserve_folder_structure"] else ""
 
+        # Creates the output folders up front, so the worker processes
+        # don't race each other while creating them
         outputPath = os.path.join(args["output"], basePath)
-        if not os.path.exists(outputPath):
-            os.mkdir(outputPath)
+        os.makedirs(outputPath, exist_ok=True)
+
+        return outputPath
+
+    def tasks():
+        nonlocal skipped, resumed, clashes
+
+        for file in findQpFiles(args["input"], args["recursive_search"], printScanError):
+            if args["watch"] and not isSettled(file):
+                # Still being downloaded or copied, the watcher converts it once it's complete
+                continue
+
+            qpFilesInInputDir.append(file)
+
+            outputPath = outputFolderOf(file)
+
+            # Without -p, mapsets with the same name in different folders end up at the same path
+            source = outputSources.setdefault(outputPathOf(file, outputPath), file)
+            if source != file:
+                clashes += 1
+                print(f"Skipping {file}, {source} is already converted to the same .osz", file=sys.stderr)
+                continue
+
+            if args["resume"] and journal.isFinished(file, outputPathOf(file, outputPath)):
+                resumed += 1
+                # Finished before the interruption, but the manifest is only saved at the end
+                if manifest is not None:
+                    manifest.record(file, outputPathOf(file, outputPath))
+                continue
+
+            if manifest is not None and manifest.isUpToDate(file, outputPathOf(file, outputPath)):
+                skipped += 1
+                continue
+
+            events.mapsetQueued(file)
+            yield file, outputPath
+
+        events.discoveryFinished()
+
+    # The workers dump their cProfile data here, it's merged after the run
+    profileFolder = None
+    if args["profile_out"] and args["profile_out"].endswith(".prof"):
+        profileFolder = tempfile.mkdtemp()
+
+    # Run the conversion for each .qp file, a broken mapset only
+    # reports its error and doesn't stop the remaining ones
+    results = []
+    failed = 0
+
+    eventsWriter = JsonLinesWriter(args["events_jsonl"]) if args["events_jsonl"] else None
+    events = ProgressEvents(args["jobs"], [eventsWriter] if eventsWriter else [])
+    events.begin()
+
+    if args["pipeline"]:
+        conversions = convertPipelined(tasks(), options, args["jobs"], args["readers"], args["writers"],
+                                       args["queue_size"], cache, profileFolder, events.mapsetStarted)
+    else:
+        conversions = convertMapsets(tasks(), options, args["jobs"], cache, profileFolder, args["max_memory"],
+                                     variants=args["variants"], onStart=events.mapsetStarted)
+
+    def handleResult(result):
+        nonlocal failed
+
+        results.append(result)
+        count = len(results)
+        events.mapsetFinished(result)
+        if result.error is None:
+            peak = ""
+            if args["max_memory"] is not None and result.peakMemory is not None:
+                peak = f", peak memory {result.peakMemory / 1024 / 1024:.1f} MiB"
+            variants = "" if result.outputPaths is None else f" into {len(result.outputPaths)} variants"
+            print(f"({count}) Converted {result.path}{variants}{' (cached)' if result.cached else ''}{peak}")
+            # The .qp may have been moved or deleted since, e.g. by a download manager while watching
+            try:
+                journal.record(result.path, result.outputPath)
+                if manifest is not None:
+                    manifest.record(result.path, result.outputPath, result.sourceHash)
+            except OSError as e:
+                print(f"Couldn't remember {result.path} for later runs: {e.strerror}", file=sys.stderr)
+        else:
+            failed += 1
+            print(f"({count}) Failed to convert {result.path}\n{result.error}")
+
+    for result in conversions:
+        handleResult(result)
 
-        print(f"Converting {file}")
-        convertQp(file, outputPath, options)
+    if args["watch"]:
+        # The mapsets that were just converted are only converted again once they change
+        watcher = FolderWatcher(args["input"], args["recursive_search"], qpFilesInInputDir, onError=printScanError)
+
+        def watchedOutputFolderOf(file):
+            if file not in qpFilesInInputDir:
+                qpFilesInInputDir.append(file)
+            events.mapsetQueued(file)
+            return outputFolderOf(file)
+
+        print("Watching for new or changed mapsets, press Ctrl+C to stop")
+        try:
+            watch(watcher, watchedOutputFolderOf, options, args["jobs"], cache, handleResult,
+                  onStart=events.mapsetStarted)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+
+    journal.close()
+
+    events.end()
+    if eventsWriter is not None:
+        eventsWriter.close()
+
+    if clashes:
+        print(f"Skipped {clashes} mapsets with the same name as another one, use -p to keep them apart")
+
+    if args["resume"]:
+        print(f"Skipped {resumed} mapsets that were already converted before the interruption")
+
+    if len(qpFilesInInputDir) == 0 and not args["watch"]:
+        print("No mapsets found in given paths")
+        sys.exit(1)
+
+    if manifest is not None:
+        print(f"Skipped {skipped} unchanged mapsets")
+
+        # Mapsets in directories that couldn't be read aren't orphans
+        if not scanErrors:
+            for outputPath in manifest.removeOrphans(qpFilesInInputDir):
+                print(f"Removed {outputPath}, its mapset isn't part of the input anymore")
+        manifest.save()
+
+    if cache is not None:
+        cache.evict()
 
     # Stops the timer for the total execution time
     end = time.time()
@@ -277,11 +589,30 @@ def main():
 
     print(f"Finished converting all mapsets, total time elapsed: {timeElapsed} seconds")
 
+    if failed:
+        print(f"{failed} of {len(results)} mapsets failed to convert")
+
+    if args["dedupe_report"]:
+        print(formatDedupeReport(results))
+
+    if options["compressionLevel"] is not None:
+        print(formatArchiveReport(results))
+
+    if args["profile"] is not None:
+        print(formatProfile(results, args["profile"]))
+
+    if args["profile_out"]:
+        writeProfile(results, args["profile_out"], profileFolder)
+        if profileFolder is not None:
+            shutil.rmtree(profileFolder)
+
     # Opens output folder in explorer
     absoluteOutputPath = os.path.realpath(args["output"])
     webbrowser.open("file:///" + absoluteOutputPath)
 
 
 if __name__ == '__main__':
+    # Required for the worker processes in frozen executables on Windows
+    multiprocessing.freeze_support()
     main()
     sys.exit(0)
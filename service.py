@@ -0,0 +1,361 @@
+"""Local HTTP service that converts mapsets without starting a new process for every call
+
+Endpoints:
+
+- `POST /convert` converts a mapset and responds with the .osz file. The body
+  is either the .qp file itself, with the options as JSON in the `options`
+  query parameter and the file name in the `name` query parameter, or a JSON
+  object `{"path": "path/to/mapset.qp", "options": {...}}` with the
+  Content-Type `application/json`. The options are the same as for
+  `convertQp()`, missing ones fall back to the defaults of the command-line tool.
+- `GET /status` responds with the amount of running and queued conversions
+  and of uploads that are still being received.
+
+Run with `py service.py --port 8000` and convert with e.g.
+`curl --data-binary @mapset.qp -o mapset.osz "http://127.0.0.1:8000/convert?name=mapset.qp"`
+"""
+
+# ## Imports
+
+import argparse  # parsing command line arguments
+import asyncio  # to serve multiple requests at once
+import concurrent.futures  # process pool for the conversions
+import io  # to hand uploaded mapsets to the zip reader
+import json  # for the options and the status
+import multiprocessing  # freeze support for the worker processes
+import os  # for paths and directories
+import shutil  # to remove the converted files after sending them
+import tempfile  # to store the converted files until they're sent
+import time  # for the uptime in the status
+import traceback  # to send conversion errors to the client
+import urllib.parse  # to parse the query parameters
+
+from conversion import DEFAULT_OPTIONS, SAMPLESETS, compressionThreadsBeside, convertQp, defaultJobs, setCompressionThreads
+
+# ## Constants
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+
+# Conversions that may wait for a free worker process before requests are rejected
+DEFAULT_QUEUE_SIZE = 16
+
+# Largest accepted request body in bytes
+MAX_BODY_SIZE = 1024 * 1024 * 1024
+
+SEND_CHUNK_SIZE = 1024 * 1024
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    503: "Service Unavailable"
+}
+
+# ## Classes
+
+
+class HttpError(Exception):
+    """Ends a request with an error status and a message"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class ConversionService:
+    """Converts mapsets sent over HTTP in a pool of `jobs` worker processes
+
+    The worker processes stay alive between requests, so reamber is only
+    imported once per process. At most `queueSize` conversions wait for a
+    free worker, further requests are rejected with 503 until there's room.
+    Uploads that are still being received count towards that limit, so
+    they're rejected before their body is read.
+    """
+
+    def __init__(self, jobs: int = None, queueSize: int = DEFAULT_QUEUE_SIZE):
+        self.jobs = jobs or defaultJobs()
+        self.queueSize = queueSize
+        self.executor = None
+        self.slots = None
+        self.running = 0
+        self.queued = 0
+        self.receiving = 0
+        self.converted = 0
+        self.failed = 0
+        self.started = time.time()
+
+    async def start(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+        """Starts the worker processes and the server, returns the `asyncio` server
+
+        Pass port 0 to pick a free port, `server.sockets[0].getsockname()` tells which one.
+        """
+
+        threads = compressionThreadsBeside(self.jobs, self.jobs)
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.jobs, initializer=setCompressionThreads, initargs=(threads,)
+        )
+        self.slots = asyncio.Semaphore(self.jobs)
+        self.started = time.time()
+
+        return await asyncio.start_server(self.handle, host, port)
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def status(self) -> dict:
+        return {
+            "jobs": self.jobs,
+            "queueSize": self.queueSize,
+            "running": self.running,
+            "queued": self.queued,
+            "receiving": self.receiving,
+            "converted": self.converted,
+            "failed": self.failed,
+            "uptime": time.time() - self.started
+        }
+
+    def isFull(self) -> bool:
+        return self.running + self.queued + self.receiving >= self.jobs + self.queueSize
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serves a single request per connection"""
+
+        try:
+            method, target, headers, length = await readHead(reader)
+            url = urllib.parse.urlsplit(target)
+
+            if url.path == "/status":
+                if method != "GET":
+                    raise HttpError(405, "Use GET for /status")
+                await sendJson(writer, 200, self.status())
+            elif url.path == "/convert":
+                if method != "POST":
+                    raise HttpError(405, "Use POST for /convert")
+                if self.isFull():
+                    raise HttpError(503, "Too many conversions queued, try again later")
+
+                self.receiving += 1
+                try:
+                    body = await reader.readexactly(length)
+                finally:
+                    self.receiving -= 1
+
+                await self.convert(writer, urllib.parse.parse_qs(url.query), headers, body)
+            else:
+                raise HttpError(404, f"Unknown endpoint {url.path}")
+        except HttpError as e:
+            await sendJson(writer, e.status, {"error": e.message})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # The client went away, there's nobody left to respond to
+            pass
+        finally:
+            writer.close()
+
+    async def convert(self, writer: asyncio.StreamWriter, query: dict, headers: dict, body: bytes) -> None:
+        """Converts the mapset of a request and sends back the .osz file"""
+
+        if headers.get("content-type", "").startswith("application/json"):
+            try:
+                request = json.loads(body)
+                path = request["path"]
+                options = request.get("options", {})
+            except (ValueError, KeyError, TypeError):
+                raise HttpError(400, "Expected a JSON object with a path and options")
+            if not isinstance(path, str):
+                raise HttpError(400, "The path must be a string")
+            if not (path.endswith(".qp") and os.path.isfile(path)):
+                raise HttpError(404, f"{path} is not a .qp file")
+            data = None
+        else:
+            try:
+                options = json.loads(query.get("options", ["{}"])[0])
+            except ValueError:
+                raise HttpError(400, "The options parameter is not valid JSON")
+            path = os.path.basename(query.get("name", ["upload.qp"])[0])
+            data = body
+
+        options = validateOptions(options)
+
+        if self.isFull():
+            raise HttpError(503, "Too many conversions queued, try again later")
+
+        outputFolder = tempfile.mkdtemp()
+
+        try:
+            self.queued += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.queued -= 1
+
+            self.running += 1
+            try:
+                loop = asyncio.get_running_loop()
+                outputPath = await loop.run_in_executor(self.executor, convertJob, path, outputFolder, options, data)
+                self.converted += 1
+            except Exception:
+                self.failed += 1
+                raise HttpError(422, traceback.format_exc())
+            finally:
+                self.running -= 1
+                self.slots.release()
+
+            await sendFile(writer, outputPath)
+        finally:
+            shutil.rmtree(outputFolder, ignore_errors=True)
+
+# ## Functions
+
+
+def convertJob(path: str, outputFolder: str, options, data: bytes = None) -> str:
+    """Runs in the worker processes, converts an uploaded mapset if `data` is given"""
+
+    source = None if data is None else io.BytesIO(data)
+    return convertQp(path, outputFolder, options, source=source)
+
+
+def validateOptions(options) -> dict:
+    """Fills in the default options and rejects invalid ones"""
+
+    if not isinstance(options, dict):
+        raise HttpError(400, "The options must be a JSON object")
+
+    unknown = set(options) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise HttpError(400, f"Unknown options: {', '.join(sorted(unknown))}")
+
+    options = {**DEFAULT_OPTIONS, **options}
+
+    # JSON booleans are ints in Python, but would end up as True and False in the .osu files
+    for key in ["od", "hp"]:
+        if not isNumber(options[key], (int, float)) or not 0 <= options[key] <= 10:
+            raise HttpError(400, f"{key} must be a number between 0 and 10")
+    if not isNumber(options["hitSoundVolume"], int) or not 0 <= options["hitSoundVolume"] <= 100:
+        raise HttpError(400, "hitSoundVolume must be an integer between 0 and 100")
+    if options["sampleSet"] not in SAMPLESETS:
+        raise HttpError(400, f"sampleSet must be one of {', '.join(SAMPLESETS)}")
+    if options["creator"] is not None and not isinstance(options["creator"], str):
+        raise HttpError(400, "creator must be a string")
+    for key in ["fast", "mmap", "dedupe"]:
+        if not isinstance(options[key], bool):
+            raise HttpError(400, f"{key} must be a boolean")
+    if options["compressionLevel"] is not None and \
+            (not isNumber(options["compressionLevel"], int) or not 0 <= options["compressionLevel"] <= 9):
+        raise HttpError(400, "compressionLevel must be an integer between 0 and 9")
+
+    return options
+
+
+def isNumber(value, types) -> bool:
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+async def readHead(reader: asyncio.StreamReader) -> tuple:
+    """Reads the head of an HTTP/1.1 request, returns the method, target, lowercase headers and body length
+
+    The body is left in the reader, so that requests can be rejected before it's received
+    """
+
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.LimitOverrunError:
+        raise HttpError(400, "Request head too large")
+
+    lines = head.decode("latin-1").split("\r\n")
+
+    try:
+        method, target, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise HttpError(400, "Malformed request line")
+
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HttpError(400, "Malformed Content-Length")
+
+    if length < 0:
+        raise HttpError(400, "Malformed Content-Length")
+    if length > MAX_BODY_SIZE:
+        raise HttpError(413, f"Request body is larger than {MAX_BODY_SIZE} bytes")
+
+    return method, target, headers, length
+
+
+async def sendHead(writer: asyncio.StreamWriter, status: int, headers: dict) -> None:
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", "Connection: close"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+
+
+async def sendJson(writer: asyncio.StreamWriter, status: int, content) -> None:
+    body = json.dumps(content).encode("utf8")
+    await sendHead(writer, status, {"Content-Type": "application/json", "Content-Length": len(body)})
+    writer.write(body)
+    await writer.drain()
+
+
+async def sendFile(writer: asyncio.StreamWriter, path: str) -> None:
+    """Streams a converted .osz file to the client in chunks"""
+
+    fileName = urllib.parse.quote(os.path.basename(path))
+
+    await sendHead(writer, 200, {
+        "Content-Type": "application/zip",
+        "Content-Length": os.path.getsize(path),
+        "Content-Disposition": f"attachment; filename*=UTF-8''{fileName}"
+    })
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(SEND_CHUNK_SIZE), b""):
+            writer.write(chunk)
+            await writer.drain()
+
+
+async def serve(host: str, port: int, jobs: int, queueSize: int) -> None:
+    service = ConversionService(jobs, queueSize)
+    server = await service.start(host, port)
+
+    address = server.sockets[0].getsockname()
+    print(f"Serving on http://{address[0]}:{address[1]} with {service.jobs} worker processes")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main():
+    argParser = argparse.ArgumentParser("Serves mapset conversions over HTTP")
+    argParser.add_argument("--host", help=f"Address to listen on, defaults to {DEFAULT_HOST}", default=DEFAULT_HOST)
+    argParser.add_argument("--port", help=f"Port to listen on, 0 picks a free one, defaults to {DEFAULT_PORT}",
+                           default=DEFAULT_PORT, type=int)
+    argParser.add_argument("-j", "--jobs", help="Amount of worker processes, defaults to the CPU count",
+                           default=defaultJobs(), type=int)
+    argParser.add_argument("--queue-size", help=f"Conversions that may wait for a worker, defaults to {DEFAULT_QUEUE_SIZE}",
+                           default=DEFAULT_QUEUE_SIZE, type=int)
+    args = argParser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.jobs, args.queue_size))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    # Required for the worker processes in frozen executables on Windows
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,130 @@
+"""Manifest of converted mapsets for incremental runs with --sync"""
+
+# ## Imports
+
+import json  # to read and write the manifest
+import os  # for paths and directories
+import tempfile  # to write the manifest atomically
+
+from cache import hashFile, outputOptions
+
+# ## Constants
+
+MANIFEST_NAME = ".qua2osu-manifest.json"
+MANIFEST_VERSION = 1
+
+# ## Classes
+
+
+class SyncManifest:
+    """Keeps track of which .qp files were converted to which .osz files
+
+    Stored as JSON in the output folder, each entry maps the absolute path
+    of a .qp file to its mtime, size and hash and the path of its .osz
+    relative to the output folder. Changing the options invalidates all
+    entries, since every mapset needs to be converted again.
+    """
+
+    def __init__(self, outputFolder: str, options):
+        self.outputFolder = outputFolder
+        self.path = os.path.join(outputFolder, MANIFEST_NAME)
+        # Options that don't change the outputs, e.g. the converter, don't invalidate them
+        self.options = outputOptions(options)
+        self.entries = {}
+
+        try:
+            with open(self.path, "r", encoding="utf8") as file:
+                manifest = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return
+
+        if manifest.get("version") == MANIFEST_VERSION and manifest.get("options") == self.options:
+            self.entries = manifest["entries"]
+
+    def isUpToDate(self, path: str, outputPath: str) -> bool:
+        """Checks if a mapset was already converted and hasn't changed since
+
+        Compares mtime and size first and only hashes the file if those differ
+        but the size is still the same, e.g. after copying the file around
+        """
+
+        entry = self.entries.get(os.path.abspath(path))
+
+        if entry is None or entry["output"] != os.path.relpath(outputPath, self.outputFolder):
+            return False
+
+        if not os.path.isfile(outputPath):
+            return False
+
+        stat = os.stat(path)
+
+        if stat.st_size != entry["size"]:
+            return False
+
+        if stat.st_mtime == entry["mtime"]:
+            return True
+
+        if hashFile(path) != entry["hash"]:
+            return False
+
+        # Same content, only remember the new mtime to skip hashing next time
+        entry["mtime"] = stat.st_mtime
+        return True
+
+    def record(self, path: str, outputPath: str, fileHash: str = None) -> None:
+        """Remembers a successfully converted mapset, only hashes it if its `hashFile()` digest isn't given"""
+
+        stat = os.stat(path)
+
+        self.entries[os.path.abspath(path)] = {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "hash": hashFile(path) if fileHash is None else fileHash,
+            "output": os.path.relpath(outputPath, self.outputFolder)
+        }
+
+    def removeOrphans(self, paths: list) -> list:
+        """Deletes the outputs of all mapsets that aren't part of `paths` anymore
+
+        Returns the list of deleted .osz files
+        """
+
+        keep = {os.path.abspath(path) for path in paths}
+        keptOutputs = {entry["output"] for path, entry in self.entries.items() if path in keep}
+        removed = []
+
+        for path in list(self.entries):
+            if path in keep:
+                continue
+
+            entry = self.entries.pop(path)
+
+            # Another mapset might have been converted to the same file since
+            if entry["output"] in keptOutputs:
+                continue
+
+            outputPath = os.path.join(self.outputFolder, entry["output"])
+            if os.path.isfile(outputPath):
+                os.remove(outputPath)
+                removed.append(outputPath)
+
+        return removed
+
+    def save(self) -> None:
+        """Writes the manifest, an interrupted run keeps the old one intact"""
+
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "options": self.options,
+            "entries": self.entries
+        }
+
+        fd, temporaryPath = tempfile.mkstemp(dir=self.outputFolder, suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as file:
+                json.dump(manifest, file, indent=1)
+            os.replace(temporaryPath, self.path)
+        except BaseException:
+            os.remove(temporaryPath)
+            raise
@@ -0,0 +1,233 @@
+"""Watching the input folders for new or changed .qp files with --watch"""
+
+# ## Imports
+
+import concurrent.futures  # warm process pool for the conversions
+import os  # for paths and directories
+import signal  # to leave Ctrl+C to the main process
+import threading  # to stop watching from another thread
+import time  # to tell how long a file has been unchanged
+
+from cache import ConversionCache
+from conversion import StartNotices, compressionThreadsBeside, convertTask, futureResult, setCompressionThreads, \
+    setStartNotices, warmUp
+from discovery import listDirectory
+
+# ## Constants
+
+# Seconds between two scans of the input folders
+POLL_INTERVAL = 0.25
+
+# Seconds a file has to stay unchanged before it counts as completely written
+SETTLE_TIME = 0.5
+
+# Seconds between two full scans, which also notice files that were overwritten in place
+FULL_SCAN_INTERVAL = 30
+
+# ## Classes
+
+
+class FolderWatcher:
+    """Finds .qp files that are new or changed since the last scan
+
+    A file is only reported once its size and mtime didn't change for
+    `settleTime` seconds, so that files which are still being downloaded or
+    copied aren't converted halfway. Files in `known` were already
+    converted and are only reported again once they change.
+
+    Directories are only listed again once their mtime changes, and only
+    the files in those directories are checked, so a poll of an unchanged
+    library costs one stat call per directory. Every `fullScanInterval`
+    seconds all files are checked, for files that were overwritten in
+    place without a change to their directory.
+    """
+
+    def __init__(self, paths: list, recursive: bool, known: list = (), settleTime: float = SETTLE_TIME, onError=None,
+                 fullScanInterval: float = FULL_SCAN_INTERVAL):
+        self.paths = paths
+        self.recursive = recursive
+        self.settleTime = settleTime
+        self.onError = onError
+        self.fullScanInterval = fullScanInterval
+        self.lastFullScan = None
+        # Maps directories to the mtime they were listed with, when, and their .qp files and subdirectories
+        self.listings = {}
+        # Maps paths to the (size, mtime) they were reported with
+        self.known = {}
+        # Maps paths to the (size, mtime) they were last seen with and since when
+        self.settling = {}
+
+        for path in known:
+            try:
+                self.known[path] = signatureOf(path)
+            except OSError:
+                pass
+
+    def poll(self) -> list:
+        """Scans the input folders once, returns the files that are ready to be converted"""
+
+        now = time.monotonic()
+        ready = []
+        seen = set()
+
+        full = self.lastFullScan is None or now - self.lastFullScan >= self.fullScanInterval
+        if full:
+            self.lastFullScan = now
+
+        for path, listed in self.scan(full):
+            seen.add(path)
+
+            # Files in unchanged directories are only checked while they're new or settling
+            if not listed and path in self.known and path not in self.settling:
+                continue
+
+            try:
+                signature = signatureOf(path)
+            except OSError:
+                # Deleted or renamed since the scan
+                continue
+
+            if self.known.get(path) == signature:
+                continue
+
+            previous = self.settling.get(path)
+
+            if previous is None or previous[0] != signature:
+                self.settling[path] = (signature, now)
+                continue
+
+            if now - previous[1] < self.settleTime:
+                continue
+
+            del self.settling[path]
+            self.known[path] = signature
+            ready.append(path)
+
+        # Forgets deleted files, so they're converted again if they come back
+        for path in set(self.known) - seen:
+            del self.known[path]
+        for path in set(self.settling) - seen:
+            del self.settling[path]
+
+        return ready
+
+    def scan(self, full: bool) -> list:
+        """Returns (path, listed) for each .qp file, `listed` if its directory was listed in this scan
+
+        A directory is listed again if `full`, if its mtime changed or if it
+        changed so shortly before it was listed that a later change could
+        have kept the same mtime.
+        """
+
+        files = []
+        directories = []
+
+        for path in self.paths:
+            if os.path.isfile(path) and path.endswith(".qp"):
+                files.append((path, True))
+            elif os.path.isdir(path):
+                directories.append(path)
+
+        directories.reverse()
+        visited = set()
+        listings = {}
+
+        while directories:
+            current = directories.pop()
+
+            try:
+                stat = os.stat(current)
+                if (stat.st_dev, stat.st_ino) in visited:
+                    continue
+                visited.add((stat.st_dev, stat.st_ino))
+
+                listing = self.listings.get(current)
+                changed = listing is None or listing[0] != stat.st_mtime_ns
+                recent = listing is not None and listing[1] - stat.st_mtime_ns < self.settleTime * 1e9
+                listed = full or changed or recent
+                if listed:
+                    listing = (stat.st_mtime_ns, time.time_ns(), *listDirectory(current, self.recursive, self.onError))
+            except OSError as e:
+                if self.onError is not None:
+                    self.onError(e)
+                continue
+
+            listings[current] = listing
+            files.extend((path, listed) for path in listing[2])
+            # Reversed, so that the subdirectories are visited in the order they were listed
+            directories.extend(reversed(listing[3]))
+
+        # Forgets directories that were deleted or aren't reachable anymore
+        self.listings = listings
+
+        return files
+
+# ## Functions
+
+
+def initWatchWorker(compressionThreads: int, notices=None) -> None:
+    """Initializer of the worker processes, Ctrl+C stops watching in the main process, which shuts the workers down"""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setCompressionThreads(compressionThreads)
+    setStartNotices(notices)
+
+
+def isSettled(path: str, settleTime: float = SETTLE_TIME) -> bool:
+    """Whether a file wasn't modified for `settleTime` seconds, so it's likely not being written anymore"""
+
+    try:
+        return time.time() - os.stat(path).st_mtime >= settleTime
+    except OSError:
+        return False
+
+
+def signatureOf(path: str) -> tuple:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def watch(watcher: FolderWatcher, outputFolderOf, options, jobs: int, cache: ConversionCache = None,
+          onResult=None, stop: threading.Event = None, pollInterval: float = POLL_INTERVAL, onStart=None) -> None:
+    """Converts the files reported by the watcher until `stop` is set
+
+    `outputFolderOf` is called with the path of each .qp file and returns
+    the folder its .osz goes into, `onResult` is called with each
+    `ConversionResult` and `onStart` with the path of each mapset once a
+    worker starts on it, see `StartNotices`. The `jobs` worker processes are started and import
+    the converter right away and stay alive the whole time, so a new
+    mapset only waits for its own conversion.
+    """
+
+    stop = stop or threading.Event()
+    notices = None if onStart is None else StartNotices(onStart)
+    initargs = (compressionThreadsBeside(jobs, jobs), None if notices is None else notices.queue)
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=initWatchWorker,
+                                                    initargs=initargs) as executor:
+            for future in [executor.submit(warmUp, options) for _ in range(jobs)]:
+                future.result()
+
+            running = {}
+
+            while not stop.is_set():
+                for path in watcher.poll():
+                    running[executor.submit(convertTask, path, outputFolderOf(path), options, cache)] = path
+
+                if not running:
+                    stop.wait(pollInterval)
+                    continue
+
+                done, _ = concurrent.futures.wait(running, timeout=pollInterval)
+
+                for future in done:
+                    path = running.pop(future)
+                    result = futureResult(path, future)
+                    if notices is not None:
+                        notices.report(path)
+                    if onResult is not None:
+                        onResult(result)
+    finally:
+        if notices is not None:
+            notices.close()